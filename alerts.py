@@ -1,25 +1,36 @@
 from twilio.rest import Client
 import os
+import metrics
 
 class Alerts:
-        
-    account_sid = os.environ["TWILIO_ACCOUNT_SID"]
-    auth_token = os.environ["TWILIO_AUTH_TOKEN"]
-
-    number = os.environ["TWILIO_NUMBER"]
-    to = os.environ["TWILIO_MY_NUMBER"]
 
     def __init__(self, logger):
+        # Read here rather than on import, so the simulator runs without Twilio credentials
+        self.account_sid = os.environ["TWILIO_ACCOUNT_SID"]
+        self.auth_token = os.environ["TWILIO_AUTH_TOKEN"]
+
+        self.number = os.environ["TWILIO_NUMBER"]
+        self.to = os.environ["TWILIO_MY_NUMBER"]
+
         self.client = Client(self.account_sid, self.auth_token)
         self.logger = logger
         self.logger.info('Twilio Alert System initialized')
 
     def alertInfo(self, msg):
         self.logger.info(f'Sending alertInfo. MSG=[{msg}]')
-        message = self.client.messages.create(body=f'[INFO] {msg}', from_=self.number, to=self.to)
+        message = self.send(f'[INFO] {msg}', 'info')
         self.logger.info(f'Alert SID {message.sid}')
 
     def alertCritical(self, msg):
         self.logger.critical(f'Sending alertCritical. MSG=[{msg}]')
-        message = self.client.messages.create(body=f'[CRITICAL] {msg}', from_=self.number, to=self.to)
+        message = self.send(f'[CRITICAL] {msg}', 'critical')
         self.logger.critical(f'Alert SID {message.sid}')
+
+    def send(self, body, level):
+        metrics.alerts_pending.inc()
+        try:
+            message = self.client.messages.create(body=body, from_=self.number, to=self.to)
+        finally:
+            metrics.alerts_pending.dec()
+        metrics.alerts_sent.inc(level)
+        return message
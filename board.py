@@ -0,0 +1,420 @@
+from threading import Thread, Event
+from queue import SimpleQueue
+from time import sleep
+from Adafruit_PCA9685 import PCA9685
+from clock import Clock
+import metrics
+
+class Board:
+    """
+    One PCA9685 pwm module, kept apart from the others so a failing or
+    stuck board never holds up or blanks the rest of the tank
+
+    ...
+
+    Frames are written from the board's own worker thread, and the main
+    loop waits at most FRAME_TIMEOUT for them. The worker is a daemon
+    thread, so a write stuck on a wedged bus does not keep the process
+    from exiting either. A write that raises is
+    retried after a short backoff. A channel that still fails is logged
+    and the rest of the frame carries on.
+
+    After FAILURE_THRESHOLD failed frames in a row, or one frame that does
+    not finish in time, the circuit breaker opens and the board is parked.
+    A parked board only remembers the frames it is given. It is probed
+    after PROBE_INTERVAL, then twice as long after each failed probe up to
+    PROBE_MAX_INTERVAL. A probe opens the board if it never opened, sets
+    its mode and frequency registers again and replays the full frame, so
+    it comes back showing the same thing as the rest of the tank.
+
+    Only channels that changed are written, and the whole frame again every
+    REFRESH_INTERVAL in case the board lost it. When every channel of the
+    frame has the same value, as in a ramp without overrides, the board's
+    ALL_LED registers set all 16 channels in one write. The channels no
+    shelf is mapped to get that value too, which does nothing as nothing
+    is wired to them. After SLEEP_AFTER seconds of a dark frame the board
+    is put to sleep, which stops its oscillator, and it is woken just
+    before the next frame that lights anything.
+
+    Channels a new pin map no longer uses are handed to apply as released.
+    They are turned off once, by the next write that goes through, and are
+    then forgotten, so they do not keep the frame from being uniform.
+
+    Parameters
+    ----------
+    logger : Logger
+        Logs and saves the data seperated by day
+    name : str
+        Name of the board, e.g. 'led', or 'A/led' for tank A. Used in the logs and as the metrics label
+    address : int
+        I2C address of the board
+    frequency : int
+        PWM frequency, in hertz
+    clock : Clock
+        Times the probes. The wall clock when None
+    pwm : object
+        An already opened module, e.g. the simulator's. Written inline, without a worker thread
+
+    Methods
+    -------
+    apply(frame, released)
+        Writes {channel: duty cycle} to the board and turns the released
+        channels off. Returns whether it was written
+    setFrequency(frequency)
+        Changes the pwm frequency, now or when the board comes back
+    close()
+        Stops the worker thread
+    """
+
+    # Longest the main loop waits for a frame to be written, in seconds
+    FRAME_TIMEOUT = 0.1
+
+    # Longest the main loop waits for the board to be opened or set up again, in seconds
+    INIT_TIMEOUT = 0.5
+
+    # Attempts after the first failed write of a channel, and the delay before the first one
+    RETRIES = 2
+    RETRY_DELAY = 0.002
+
+    # Failed frames in a row before the board is parked
+    FAILURE_THRESHOLD = 3
+
+    # Delay before probing a parked board, doubled after each failed probe, in seconds
+    PROBE_INTERVAL = 5
+    PROBE_MAX_INTERVAL = 300
+
+    # Seconds between two writes of the whole frame
+    REFRESH_INTERVAL = 60
+
+    # Seconds of all channels off before the board goes to sleep
+    SLEEP_AFTER = 60
+
+    # Registers and bits the Adafruit driver sets up when it opens a board
+    MODE1 = 0x00
+    MODE2 = 0x01
+    ALLCALL = 0x01
+    OUTDRV = 0x04
+    SLEEP = 0x10
+    RESTART = 0x80
+
+    def __init__(self, logger, name, address, frequency, clock=None, pwm=None):
+        self.logger = logger
+        self.name = name
+        self.address = address
+        self.frequency = frequency
+        self.clock = clock or Clock()
+        self.pwm = pwm
+
+        # A real board can wedge the bus, so it is only ever written from its own thread
+        self.worker = None if pwm else BoardWorker('board-' + name)
+        self.busy = None
+
+        # Latest duty cycle of every channel, replayed when the board comes back
+        self.frame = {}
+
+        # Channels no longer mapped, until they have been turned off
+        self.released = set()
+
+        # What the board is known to hold. Only touched by the worker thread
+        self.written = {}
+        self.next_refresh = 0
+        self.dark_since = None
+        self.asleep = False
+
+        self.failures = 0
+        self.parked = False
+        self.probe_interval = self.PROBE_INTERVAL
+        self.next_probe = 0
+
+        metrics.board_parked.set(0, name)
+        metrics.board_asleep.set(0, name)
+
+        if pwm is None:
+            if self.run(self.initialise, timeout=self.INIT_TIMEOUT):
+                self.logger.info(f'Initialized the {self.describe()}')
+            else:
+                self.park('it could not be opened')
+
+    def apply(self, frame, released=()):
+        self.frame = dict(frame)
+
+        # A channel that was mapped again before it was turned off just takes its new value
+        self.released = (self.released | set(released)) - self.frame.keys()
+
+        if self.parked:
+            if self.clock.monotonic() < self.next_probe:
+                return False
+            return self.probe()
+
+        full = self.clock.monotonic() >= self.next_refresh
+        if full:
+            self.next_refresh = self.clock.monotonic() + self.REFRESH_INTERVAL
+
+        released = set(self.released)
+        if self.run(self.writeFrame, dict(self.frame), full, released):
+            self.failures = 0
+            self.released -= released
+            return True
+
+        self.failures += 1
+        if self.busy is not None:
+            self.park(f'no answer within {self.FRAME_TIMEOUT}s')
+        elif self.failures >= self.FAILURE_THRESHOLD:
+            self.park(f'{self.failures} frames failed in a row')
+        return False
+
+    def setFrequency(self, frequency):
+        self.frequency = frequency
+        if self.parked:
+            return True
+
+        if self.run(self.pwm.set_pwm_freq, frequency, timeout=self.INIT_TIMEOUT):
+            return True
+
+        if self.busy is not None:
+            self.park(f'no answer within {self.INIT_TIMEOUT}s')
+        return False
+
+    def probe(self):
+        self.logger.info(f'Probing the parked {self.describe()}')
+
+        released = set(self.released)
+        if self.run(self.recover, released, timeout=self.INIT_TIMEOUT):
+            self.released -= released
+            self.parked = False
+            self.failures = 0
+            self.probe_interval = self.PROBE_INTERVAL
+            metrics.board_parked.set(0, self.name)
+            metrics.board_recoveries.inc(self.name)
+            self.logger.info(f'The {self.describe()} is back. Replayed the full frame')
+            return True
+
+        self.probe_interval = min(self.probe_interval * 2, self.PROBE_MAX_INTERVAL)
+        self.park('the probe got no answer' if self.busy is not None else 'the probe failed')
+        return False
+
+    def park(self, reason):
+        if not self.parked:
+            self.logger.critical(f'Parking the {self.describe()}: {reason}. Probing again in {self.probe_interval}s')
+        else:
+            self.logger.critical(f'The {self.describe()} is still failing: {reason}. Probing again in {self.probe_interval}s')
+
+        self.parked = True
+        self.next_probe = self.clock.monotonic() + self.probe_interval
+        metrics.board_parked.set(1, self.name)
+
+    def run(self, function, *args, timeout=None):
+        """Calls function(*args) on the worker thread, waiting at most
+        timeout (FRAME_TIMEOUT when None). Returns whether it finished
+        without raising. A call that did not finish in time is left in
+        busy, and the caller decides whether to park the board
+        """
+        if self.worker is None:
+            try:
+                function(*args)
+            except Exception as e:
+                self.logger.critical(f'The {self.describe()} failed. Exception: {e}')
+                return False
+            return True
+
+        # A write that timed out may still hold the bus. Nothing else is queued behind it
+        if self.busy is not None:
+            if not self.busy.done():
+                return False
+            self.busy = None
+
+        call = self.worker.submit(function, *args)
+        if not call.wait(timeout or self.FRAME_TIMEOUT):
+            self.busy = call
+            return False
+
+        if call.error is not None:
+            self.logger.critical(f'The {self.describe()} failed. Exception: {call.error}')
+            return False
+        return True
+
+    def initialise(self):
+        if self.pwm is None:
+            self.pwm = PCA9685(address=self.address)
+        elif hasattr(self.pwm, '_device'):
+            # What the driver does when it opens the board, without turning every channel off first
+            self.pwm._device.write8(self.MODE2, self.OUTDRV)
+            self.pwm._device.write8(self.MODE1, self.ALLCALL)
+            sleep(0.005)
+
+        self.pwm.set_pwm_freq(self.frequency)
+
+        # Opening or setting up the board again leaves it awake
+        self.asleep = False
+        metrics.board_asleep.set(0, self.name)
+
+    def recover(self, released=()):
+        self.initialise()
+        self.writeFrame(dict(self.frame), True, released)
+
+    def writeFrame(self, frame, full=False, released=()):
+        frame = {**frame, **dict.fromkeys(released, 0)}
+        values = set(frame.values())
+        dark = values <= {0}
+
+        # A sleeping board is dark whatever it holds, so it is left alone
+        if full and not (dark and self.asleep):
+            self.written = {}
+
+        changed = {channel: value for channel, value in frame.items() if self.written.get(channel) != value}
+
+        if changed and not dark and self.asleep:
+            self.wake()
+
+        if len(changed) > 1 and len(values) == 1:
+            value = values.pop()
+            if self.writeAll(value):
+                self.written = dict.fromkeys(frame, value)
+                changed = {}
+
+        failed = [channel for channel, value in changed.items() if not self.writeChannel(channel, value)]
+
+        # Released channels are off now, or are written again with the next frame. Either way they are not tracked
+        for channel in released:
+            self.written.pop(channel, None)
+
+        if dark and not failed:
+            self.idle()
+        else:
+            self.dark_since = None
+
+        if failed:
+            raise IOError(f'channels {failed} were not written')
+
+    def writeChannel(self, channel, value):
+        if self.retry(self.pwm.set_pwm, channel, 0, value):
+            self.written[channel] = value
+            return True
+
+        self.logger.critical(f'Unable to set channel {channel} of the {self.describe()} to {value}. Exception: {self.error}')
+        return False
+
+    def writeAll(self, value):
+        # One write to the ALL_LED registers sets every channel
+        if self.retry(self.pwm.set_all_pwm, 0, value):
+            return True
+
+        self.logger.critical(f'Unable to set every channel of the {self.describe()} to {value}. Writing them one by one. Exception: {self.error}')
+        return False
+
+    def retry(self, function, *args):
+        for attempt in range(self.RETRIES + 1):
+            metrics.i2c_writes.inc(self.name)
+            try:
+                function(*args)
+                return True
+            except Exception as e:
+                metrics.i2c_failures.inc(self.name)
+                self.error = e
+
+            if attempt < self.RETRIES:
+                sleep(self.RETRY_DELAY * 2 ** attempt)
+
+        return False
+
+    def idle(self):
+        if self.dark_since is None:
+            self.dark_since = self.clock.monotonic()
+        elif not self.asleep and self.clock.monotonic() - self.dark_since >= self.SLEEP_AFTER:
+            self.sleep()
+
+    def sleep(self):
+        # Only a real PCA9685 has the mode register to sleep with
+        if not hasattr(self.pwm, '_device'):
+            return
+
+        try:
+            mode1 = self.pwm._device.readU8(self.MODE1)
+            # Writing RESTART back as 1 would restart the outputs, so it is left out
+            self.pwm._device.write8(self.MODE1, (mode1 & ~self.RESTART) | self.SLEEP)
+        except Exception as e:
+            self.logger.critical(f'Unable to put the {self.describe()} to sleep. Exception: {e}')
+            return
+
+        self.asleep = True
+        metrics.board_asleep.set(1, self.name)
+        self.logger.info(f'The {self.describe()} is dark. Put it to sleep')
+
+    def wake(self):
+        # Raises like a failed write, so a board that does not wake is counted and eventually parked
+        mode1 = self.pwm._device.readU8(self.MODE1)
+        self.pwm._device.write8(self.MODE1, mode1 & ~self.SLEEP & ~self.RESTART)
+
+        # The oscillator needs 500us to start again
+        sleep(0.0005)
+        if mode1 & self.RESTART:
+            self.pwm._device.write8(self.MODE1, (mode1 & ~self.SLEEP) | self.RESTART)
+
+        self.asleep = False
+        metrics.board_asleep.set(0, self.name)
+        self.logger.info(f'Woke up the {self.describe()}')
+
+    def describe(self):
+        return f'{self.name} pwm module at {hex(self.address)}'
+
+    def close(self):
+        if self.worker:
+            self.worker.shutdown()
+
+class BoardWorker:
+    """
+    The thread a Board is written from
+
+    ...
+
+    A daemon thread running the submitted calls one after the other. A call
+    stuck on a wedged bus is given up on by the Board, and the thread is
+    never waited for, so it cannot keep the process from exiting.
+    """
+
+    def __init__(self, name):
+        self.calls = SimpleQueue()
+        self.thread = Thread(target=self.loop, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args):
+        call = BoardCall(function, args)
+        self.calls.put(call)
+        return call
+
+    def loop(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            call.run()
+
+    def shutdown(self):
+        # Stops the thread after the calls already queued. Returns at once
+        self.calls.put(None)
+
+class BoardCall:
+    """A pending call of BoardWorker.submit"""
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.error = None
+        self.finished = Event()
+
+    def run(self):
+        try:
+            self.function(*self.args)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished.set()
+
+    def done(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout):
+        """Waits at most timeout seconds. Returns whether the call finished.
+        What it raised, if anything, is in error
+        """
+        return self.finished.wait(timeout)
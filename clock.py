@@ -0,0 +1,161 @@
+from datetime import datetime
+from threading import Thread, Condition, Lock
+import logging
+import heapq
+import time
+
+class Clock:
+    """
+    Wall clock used by the controller. Every class that needs the time,
+    a sleep or a timer takes one of these, so the simulator can swap in
+    a VirtualClock
+
+    Methods
+    -------
+    now()
+        Local date and time, like datetime.now()
+    time()
+        Seconds since the epoch, like time.time()
+    monotonic()
+        Seconds that never go backwards, like time.monotonic()
+    sleep(seconds)
+        Blocks for the given seconds
+    timer(delay, function, args)
+        Calls function(*args) once after delay seconds. Returns something with cancel()
+
+    Every timer of a clock runs on the one 'timers' thread, started with
+    the first timer, instead of a new thread per timer. A timer should
+    return quickly, or it holds up the ones due after it. A timer that
+    raises is logged to logger and the others carry on.
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger('clock')
+        self.condition = Condition()
+        self.timers = []
+        self.timer_count = 0
+        self.thread = None
+
+    def now(self):
+        return datetime.now()
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def timer(self, delay, function, args=()):
+        timer = ClockTimer(function, args)
+        with self.condition:
+            # The count keeps timers due at the same moment in creation order
+            self.timer_count += 1
+            heapq.heappush(self.timers, (time.monotonic() + delay, self.timer_count, timer))
+
+            if self.thread is None:
+                self.thread = Thread(target=self.runTimers, name='timers', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return timer
+
+    def runTimers(self):
+        while True:
+            with self.condition:
+                while not self.timers or self.timers[0][0] > time.monotonic():
+                    self.condition.wait(self.timers[0][0] - time.monotonic() if self.timers else None)
+                due, count, timer = heapq.heappop(self.timers)
+
+            if timer.cancelled:
+                continue
+
+            # One failing timer must not stop the others
+            try:
+                timer.function(*timer.args)
+            except Exception:
+                self.logger.exception(f'Timer {timer.function.__name__} failed')
+
+class ClockTimer:
+    """A pending call of Clock.timer or VirtualClock.timer"""
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class VirtualClock(Clock):
+    """
+    Clock that only moves when told to. sleep() moves it forward instead
+    of blocking, and timers run on the caller's thread as their time is
+    passed, so a whole day runs in as long as the work itself takes.
+
+    Time is kept as seconds since the epoch and turned into local time
+    with tz, so daylight saving changes happen the way they would on the Pi.
+
+    Parameters
+    ----------
+    start : datetime
+        Where the clock starts. Naive datetimes are read in tz
+    tz : tzinfo
+        Time zone of now(). The system time zone when None
+    """
+
+    def __init__(self, start, tz=None):
+        if start.tzinfo is None and tz is not None:
+            start = start.replace(tzinfo=tz)
+
+        self.tz = tz
+        self.seconds = start.timestamp()
+        self.elapsed = 0.0
+
+        self.lock = Lock()
+        self.timers = []
+        self.timer_count = 0
+
+    def now(self):
+        if self.tz is None:
+            return datetime.fromtimestamp(self.seconds)
+        return datetime.fromtimestamp(self.seconds, self.tz).replace(tzinfo=None)
+
+    def time(self):
+        return self.seconds
+
+    def monotonic(self):
+        return self.elapsed
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def timer(self, delay, function, args=()):
+        timer = ClockTimer(function, args)
+        with self.lock:
+            # The count keeps timers due at the same moment in creation order
+            self.timer_count += 1
+            heapq.heappush(self.timers, (self.elapsed + delay, self.timer_count, timer))
+        return timer
+
+    def advance(self, seconds):
+        """Moves the clock forward, running every timer that comes due on the way"""
+        end = self.elapsed + seconds
+
+        while True:
+            with self.lock:
+                if not self.timers or self.timers[0][0] > end:
+                    break
+                due, count, timer = heapq.heappop(self.timers)
+
+            self.moveTo(due)
+            if not timer.cancelled:
+                timer.function(*timer.args)
+
+        self.moveTo(end)
+
+    def moveTo(self, elapsed):
+        if elapsed > self.elapsed:
+            self.seconds += elapsed - self.elapsed
+            self.elapsed = elapsed
@@ -0,0 +1,207 @@
+from collections import namedtuple
+from types import MappingProxyType
+import json
+import os
+from schedule import Schedule, FixedTimes
+from solar import SolarTimes
+from electronics import Electronics
+from connection import Connection
+
+ScheduleConfig = namedtuple('ScheduleConfig', 'sunrise sunset duration latitude longitude photoperiod')
+PwmConfig = namedtuple('PwmConfig', 'frequency led_pins rgb_pins')
+MqttConfig = namedtuple('MqttConfig', 'broker rgb_debounce anti_timeout anti_interference')
+
+# times is what the schedule section compiles to, ready to hand to a Schedule.
+# schedule_set tells whether the file has a schedule section at all, even one with the default times
+Config = namedtuple('Config', 'schedule pwm mqtt times schedule_set')
+
+class ConfigError(ValueError):
+    pass
+
+class ConfigFile:
+    """
+    Controller configuration read from a JSON file and checked for changes
+
+    ...
+
+    Every section and key is optional. Anything left out keeps the value
+    the code has always used:
+
+        {
+            "schedule": {"sunrise": "07:00", "sunset": "19:00", "duration": 30,
+                         "latitude": 40.71, "longitude": -74.01, "photoperiod": [8, 12]},
+            "pwm": {"frequency": 120,
+                    "led_pins": {"A1": 11, "A2": 10, ...},
+                    "rgb_pins": {"A": [8, 9, 10], ...}},
+            "mqtt": {"broker": "mqtt.dioty.co", "rgb_debounce": 1,
+                     "anti_timeout": 0.1, "anti_interference": 0.5}
+        }
+
+    A file is validated and compiled into namedtuples before anything
+    uses it. A broken file is reported and the running config is kept.
+
+    Methods
+    -------
+    load()
+        Reads and compiles the file
+    changed()
+        Tells whether the file was modified since it was last read
+    """
+
+    # Least time between two checks of the file, in seconds
+    POLL_INTERVAL = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+
+    def changed(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_mtime_ns, stat.st_size) != self.stamp
+
+    def load(self):
+        try:
+            stat = os.stat(self.path)
+            with open(self.path) as f:
+                raw = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            # Remembered anyway so a broken file is reported once, not every poll
+            self.stamp = self.currentStamp()
+            raise ConfigError(f'Unable to read \'{self.path}\': {e}')
+
+        self.stamp = (stat.st_mtime_ns, stat.st_size)
+        return compileConfig(raw)
+
+    def currentStamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+def defaults():
+    return compileConfig({})
+
+def compileConfig(raw):
+    if not isinstance(raw, dict):
+        raise ConfigError('The config must be a JSON object')
+
+    unknown = set(raw) - {'schedule', 'pwm', 'mqtt'}
+    if unknown:
+        raise ConfigError(f'Unknown config sections {sorted(unknown)}')
+
+    schedule = compileSchedule(section(raw, 'schedule', ScheduleConfig))
+    pwm = compilePwm(section(raw, 'pwm', PwmConfig))
+    mqtt = compileMqtt(section(raw, 'mqtt', MqttConfig))
+
+    if schedule.latitude is not None:
+        min_hours, max_hours = schedule.photoperiod or (None, None)
+        times = SolarTimes(schedule.latitude, schedule.longitude, duration=schedule.duration, min_hours=min_hours, max_hours=max_hours)
+    else:
+        times = FixedTimes(schedule.sunrise, schedule.sunset, schedule.duration)
+
+    return Config(schedule, pwm, mqtt, times, 'schedule' in raw)
+
+def section(raw, name, kind):
+    values = raw.get(name, {})
+    if not isinstance(values, dict):
+        raise ConfigError(f'\'{name}\' must be an object')
+
+    unknown = set(values) - set(kind._fields)
+    if unknown:
+        raise ConfigError(f'Unknown keys in \'{name}\': {sorted(unknown)}')
+
+    return values
+
+def compileSchedule(values):
+    sunrise = values.get('sunrise', Schedule.sunrise)
+    sunset = values.get('sunset', Schedule.sunset)
+    duration = values.get('duration', Schedule.duration)
+    latitude = values.get('latitude')
+    longitude = values.get('longitude')
+    photoperiod = values.get('photoperiod')
+
+    sunrise_minutes = clockTime('sunrise', sunrise)
+    sunset_minutes = clockTime('sunset', sunset)
+
+    if not isNumber(duration) or not isinstance(duration, int) or duration <= 0:
+        raise ConfigError('schedule \'duration\' must be a positive whole number of minutes')
+    if latitude is None and sunrise_minutes + duration > sunset_minutes:
+        raise ConfigError('schedule \'sunrise\' ramp must end before \'sunset\'')
+    if latitude is None and sunset_minutes + duration > 24 * 60:
+        raise ConfigError('schedule \'sunset\' ramp must end by 24:00')
+
+    if (latitude is None) != (longitude is None):
+        raise ConfigError('schedule \'latitude\' and \'longitude\' go together')
+    if latitude is not None:
+        if not isNumber(latitude) or not isNumber(longitude) or not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            raise ConfigError(f'Invalid location {latitude}, {longitude}')
+
+    if photoperiod is not None:
+        if latitude is None:
+            raise ConfigError('schedule \'photoperiod\' needs a \'latitude\' and \'longitude\'')
+        if not isinstance(photoperiod, list) or len(photoperiod) != 2 or not all(isNumber(hours) for hours in photoperiod) or not 0 <= photoperiod[0] <= photoperiod[1] <= 24:
+            raise ConfigError('schedule \'photoperiod\' must be [min hours, max hours]')
+        photoperiod = tuple(photoperiod)
+
+    return ScheduleConfig(sunrise, sunset, duration, latitude, longitude, photoperiod)
+
+def compilePwm(values):
+    frequency = values.get('frequency', Electronics.PWM_FREQUENCY)
+    led_pins = values.get('led_pins', Electronics.LED_PINS)
+    rgb_pins = values.get('rgb_pins', Electronics.RGB_PINS)
+
+    # The PCA9685 prescaler covers roughly 24 Hz to 1526 Hz
+    if not isNumber(frequency) or not 24 <= frequency <= 1526:
+        raise ConfigError('pwm \'frequency\' must be between 24 and 1526 Hz')
+
+    # Settings has a fixed set of shelves and racks, so the maps must cover exactly those
+    if not isinstance(led_pins, dict) or set(led_pins) != set(Electronics.LED_PINS):
+        raise ConfigError(f'pwm \'led_pins\' must map exactly the shelves {sorted(Electronics.LED_PINS)}')
+    if not isinstance(rgb_pins, dict) or set(rgb_pins) != set(Electronics.RGB_PINS):
+        raise ConfigError(f'pwm \'rgb_pins\' must map exactly the racks {sorted(Electronics.RGB_PINS)}')
+
+    led_channels = list(led_pins.values())
+    rgb_channels = [channel for pins in rgb_pins.values() for channel in (pins if isinstance(pins, (list, tuple)) else [None])]
+
+    if any(isinstance(pins, (list, tuple)) and len(pins) != 3 for pins in rgb_pins.values()):
+        raise ConfigError('pwm \'rgb_pins\' must give 3 channels per rack')
+    for channel in led_channels + rgb_channels:
+        if not isinstance(channel, int) or not 0 <= channel <= 15:
+            raise ConfigError(f'pwm channel {channel} must be between 0 and 15')
+    if len(set(led_channels)) != len(led_channels) or len(set(rgb_channels)) != len(rgb_channels):
+        raise ConfigError('pwm channels are used twice on the same board')
+
+    led_pins = MappingProxyType(dict(led_pins))
+    rgb_pins = MappingProxyType({rack: tuple(pins) for rack, pins in rgb_pins.items()})
+    return PwmConfig(frequency, led_pins, rgb_pins)
+
+def compileMqtt(values):
+    broker = values.get('broker', Connection.broker)
+    rgb_debounce = values.get('rgb_debounce', Connection.RGB_DEBOUNCE)
+    anti_timeout = values.get('anti_timeout', Connection.ANTI_TIMEOUT)
+    anti_interference = values.get('anti_interference', Connection.ANTI_INTERFERENCE)
+
+    if not isinstance(broker, str) or not broker:
+        raise ConfigError('mqtt \'broker\' must be a host name')
+    for name, delay in (('rgb_debounce', rgb_debounce), ('anti_timeout', anti_timeout), ('anti_interference', anti_interference)):
+        if not isNumber(delay) or not 0 <= delay <= 10:
+            raise ConfigError(f'mqtt \'{name}\' must be between 0 and 10 seconds')
+
+    return MqttConfig(broker, rgb_debounce, anti_timeout, anti_interference)
+
+def clockTime(name, value):
+    try:
+        hours, minutes = value.split(':')
+        hours, minutes = int(hours), int(minutes)
+    except (AttributeError, ValueError):
+        raise ConfigError(f'schedule \'{name}\' must look like 07:00')
+    if not 0 <= hours <= 23 or not 0 <= minutes <= 59:
+        raise ConfigError(f'schedule \'{name}\' must look like 07:00')
+    return hours * 60 + minutes
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
@@ -1,9 +1,10 @@
 import paho.mqtt.client as mqtt
-from datetime import datetime
-from threading import Thread
-from time import sleep, time
+from threading import Thread, Lock
+from time import perf_counter
 from settings import Settings
-from alerts import Alerts
+from payload import Payload
+from clock import Clock
+import metrics
 
 class Stage:
     ignore = 'Ignore'
@@ -14,28 +15,44 @@ class Connection:
 
     broker = 'mqtt.dioty.co'
     rgb_default = 'RGBA(0,0,0, 255)'
+    rgb_default_color = Payload.color(rgb_default)
 
     # Define when to time out, in seconds
     TIMEOUT = 10
 
-    def __init__(self, logger, settings, email, pwd):
+    # How long to wait for the colour picker to settle before applying a colour, in seconds
+    RGB_DEBOUNCE = 1
+
+    # Pauses between publishes, and before undoing a request that was not allowed, in seconds
+    ANTI_TIMEOUT = 0.1
+    ANTI_INTERFERENCE = 0.5
+
+    def __init__(self, logger, settings, email, pwd, clock=None, client=None, root=None):
 
         self.logger = logger
         self.settings = settings
+        self.clock = clock or Clock()
 
-        self.client = mqtt.Client('python1')
-        self.client.username_pw_set(username=email, password=pwd)
+        # Only the connection that made the client takes it apart in release()
+        self.owns_client = client is None
 
-        self.client.on_connect = self.on_connect
-        self.client.on_disconnect = self.on_disconnect
-        self.client.on_message = self.on_message
+        if client is None:
+            self.client = self.newClient()
+            self.client.username_pw_set(username=email, password=pwd)
+
+            self.client.on_connect = self.on_connect
+            self.client.on_disconnect = self.on_disconnect
+            self.client.on_message = self.on_message
+        else:
+            # Client of a Hub. The Hub gets the callbacks and routes this tank's messages here
+            self.client = client
 
         self.established_connection = False
         self.is_connecting = False
         self.failed_connection = False
         self.connection_closed = False
 
-        self.root = '/'+email+'/'
+        self.root = root or '/'+email+'/'
         self.root_len = len(self.root)
 
         self.led_control_topic = self.root + 'led/control/'
@@ -45,14 +62,36 @@ class Connection:
 
         self.stage = Stage.ignore
 
-        self.currently_listening = False
-        self.current_thread = None
-        self.last_color = None
+        # Start from the class defaults. configure() swaps in the ones from the config file
+        self.rgb_debounce = self.RGB_DEBOUNCE
+        self.anti_timeout = self.ANTI_TIMEOUT
+        self.anti_interference = self.ANTI_INTERFERENCE
 
-        self.last_started = datetime.now()
+        # Latest colour per rack and the timer that will apply it
+        self.color_lock = Lock()
+        self.pending_colors = {}
+        self.color_timers = {}
+
+        self.last_started = self.clock.now()
 
         self.logger.info('Initialized a connection with broker \''+self.broker+'\' with username \''+email+'\'')
     
+    def newClient(self):
+        return mqtt.Client('python1')
+
+    def configure(self, mqtt):
+        """Applies the mqtt section of the config. Takes effect on the next
+        message. A new broker is only used by the next connection
+        """
+        self.rgb_debounce = mqtt.rgb_debounce
+        self.anti_timeout = mqtt.anti_timeout
+        self.anti_interference = mqtt.anti_interference
+
+        if mqtt.broker != self.broker:
+            # Only read when connecting, so a running connection keeps its broker
+            self.logger.info(f'Broker \'{mqtt.broker}\' will be used on the next connection')
+            self.broker = mqtt.broker
+
     def start(self, happyfish):
         self.logger.info('Attempting to connect to MQTT broker')
 
@@ -81,7 +120,7 @@ class Connection:
                 count += 1
                 self.logger.info('Waiting for connection... Attempt '+str(count))
 
-            sleep(1)
+            self.clock.sleep(1)
 
         if self.failed_connection:
             self.logger.critical('FAILED to connect with MQTT broker')
@@ -92,7 +131,16 @@ class Connection:
 
     def established(self):
         self.logger.info('Connection is established with the MQTT broker')
-        
+
+        self.beginRetained()
+
+        self.logger.info('Subscribing to root topic \''+self.root+'#\'')
+        self.client.subscribe(self.root+'#')
+
+        self.clock.sleep(2)
+        self.endRetained()
+
+    def beginRetained(self):
         self.logger.debug('Switching stage to RETAINED')
         self.stage = Stage.retained
 
@@ -101,10 +149,7 @@ class Connection:
 
         self.dummy_settings.printConfig()
 
-        self.logger.info('Subscribing to root topic \''+self.root+'#\'')
-        self.client.subscribe(self.root+'#')
-
-        sleep(2)
+    def endRetained(self):
         self.logger.info('Retrieved all retained messages')
         self.dummy_settings.printConfig()
 
@@ -112,7 +157,7 @@ class Connection:
         self.logger.info('Fixing conflicting retained settings')
         self.fix_conflicts()
 
-        sleep(1)
+        self.clock.sleep(1)
         self.logger.info('Final dummy settings')
         self.dummy_settings.printConfig()
 
@@ -128,31 +173,49 @@ class Connection:
         self.client.loop_stop()
         self.client.disconnect()
 
+    def release(self):
+        """Lets go of everything once a new connection replaces this one.
+        Pending colours are dropped, and the client's callbacks are cleared so
+        the old paho client and its sockets are freed straight away
+        """
+        with self.color_lock:
+            for timer in self.color_timers.values():
+                timer.cancel()
+            self.color_timers.clear()
+            self.pending_colors.clear()
+
+        self.dummy_settings = None
+
+        if self.owns_client:
+            self.client.on_connect = None
+            self.client.on_disconnect = None
+            self.client.on_message = None
+
     def on_connect(self, client, userdata, flags, rc):
         self.is_connecting = False
         if rc == 0:
             self.established_connection = True
             self.logger.info('Connected with MQTT broker, result code: '+str(rc))
             self.happyfish.reconnect_delay = 60
-            alerts = Alerts(self.logger)
-            alerts.alertInfo('Raspberry Pi connected to MQTT successfully')
+            self.happyfish.alerts.alertInfo('Raspberry Pi connected to MQTT successfully')
         else:
             self.established_connection = False
             self.failed_connection = True
             self.logger.critical('Bad connection, result code: '+str(rc))
             self.happyfish.reconnect_delay = self.happyfish.reconnect_delay * 2
-            alerts = Alerts(self.logger)
-            alerts.alertCritical(f'Raspberry Pi could NOT connect to MQTT. Bad Connection. RC {rc}')
+            self.happyfish.alerts.alertCritical(f'Raspberry Pi could NOT connect to MQTT. Bad Connection. RC {rc}')
 
     def on_disconnect(self, client, userdata, flags, rc=0):
         self.logger.critical('Connection disconnected, return code: '+str(rc))
         self.happyfish.reconnect_delay = self.happyfish.reconnect_delay * 2
         self.connection_closed = True
-        self.time_ended = time()
-        alerts = Alerts(self.logger)
-        alerts.alertCritical(f'RPi disconnected from the MQTT server. RC {rc}')
+        self.time_ended = self.clock.time()
+        self.happyfish.alerts.alertCritical(f'RPi disconnected from the MQTT server. RC {rc}')
 
     def on_message(self, client, userdata, message):
+        stage = self.stage
+        started = perf_counter()
+
         if self.stage == Stage.ignore:
             self.on_ignore(message)
         if self.stage == Stage.retained:
@@ -160,6 +223,9 @@ class Connection:
         if self.stage == Stage.listening:
             self.on_listening(message)
 
+        metrics.messages.inc(stage)
+        metrics.handler_seconds.observe(perf_counter() - started, stage)
+
     def on_ignore(self, message):
         self.logger.info(f'Ignoring TOPIC [{message.topic}] MESSAGE [{message.payload}]')
     
@@ -168,19 +234,18 @@ class Connection:
         try:
             if message.topic:
                 topics = message.topic[self.root_len:].split('/')
-                msg = self.format(str(message.payload))
 
                 if len(topics) == 3:
                     if topics[0] == 'led':
                         if topics[1] == 'control':
-                            self.dummy_settings.led_control(topics[2], msg)
+                            self.dummy_settings.led_control(topics[2], Payload.text(message.payload))
                         if topics[1] == 'brightness':
-                            self.dummy_settings.led_brightness(topics[2], msg)
+                            self.dummy_settings.led_brightness(topics[2], Payload.text(message.payload))
                     if topics[0] == 'rgb':
                         if topics[1] == 'control':
-                            self.dummy_settings.rgb_control(topics[2], msg)
+                            self.dummy_settings.rgb_control(topics[2], Payload.text(message.payload))
                         if topics[1] == 'color':
-                            self.dummy_settings.rgb_color(topics[2], msg)
+                            self.dummy_settings.rgb_color(topics[2], Payload.color(message.payload))
 
         except Exception as e:
             self.logger.critical('Unable to parse the incoming topic')
@@ -192,31 +257,27 @@ class Connection:
         try:
             if message.topic:
                 topics = message.topic[self.root_len:].split('/')
-                msg = self.format(str(message.payload))
 
                 if len(topics) == 3:
                     if topics[0] == 'led':
                         if topics[1] == 'reset':
                             self.led_reset(topics[2])
                         if topics[1] == 'control':
-                            self.led_control(topics[2], msg == 'True')
+                            self.led_control(topics[2], Payload.text(message.payload) == 'True')
                         if topics[1] == 'brightness':
-                            self.led_brightness(topics[2], int(msg))
+                            self.led_brightness(topics[2], int(message.payload))
                     if topics[0] == 'rgb':
                         if topics[1] == 'reset':
                             self.rgb_reset(topics[2])
                         if topics[1] == 'control':
-                            self.rgb_control(topics[2], msg == 'True')
+                            self.rgb_control(topics[2], Payload.text(message.payload) == 'True')
                         if topics[1] == 'color':
-                            self.rgb_color(topics[2], str(msg))
+                            self.rgb_color(topics[2], Payload.color(message.payload))
 
         except Exception as e:
             self.logger.critical('Unable to parse the incoming topic')
             self.logger.critical('Exception: '+str(e))
 
-    def format(self, message):
-        return message[2:len(message)-1]   
-
     def fix_conflicts(self):
         for rack in self.dummy_settings.rgbs.keys():
             if self.dummy_settings.rgbs[rack][0]:
@@ -228,10 +289,9 @@ class Connection:
                     self.publish_led_brightness(shelf, 0)
                     self.dummy_settings.led_brightness(shelf, 0)
             else:
-                color = self.dummy_settings.rgbs[rack][1]
-                if color[0] != 0 or color[1] != 0 or color[2] != 0:
+                if self.dummy_settings.rgbs[rack][1] != self.rgb_default_color:
                     self.publish_rgb_color(rack, self.rgb_default)
-                    self.dummy_settings.rgb_color(rack, self.rgb_default)
+                    self.dummy_settings.rgb_color(rack, self.rgb_default_color)
         
         for shelf in self.dummy_settings.leds.keys():
             if not self.dummy_settings.leds[shelf][0]:
@@ -290,70 +350,65 @@ class Connection:
             if self.settings.leds[shelf][0]:
                 self.led_reset(shelf)
         else:
-            color = self.settings.rgbs[rack][1]
-            if color[0] != 0 or color[1] != 0 or color[2] != 0:
+            if self.settings.rgbs[rack][1] != self.rgb_default_color:
                 self.publish_rgb_color(rack, self.rgb_default)
 
         self.settings.rgb_control(rack, control)
     
     def rgb_color(self, rack, color):
-        self.logger.info(f'Incoming request RGB color for rack \'{rack}\' color \'{color}\'')
+        self.logger.info(f'Incoming request RGB color for rack \'{rack}\' color \'{Payload.rgba(color)}\'')
         
-        if color == self.settings.rgbs[rack][2]:
-            self.logger.info(f'Rack {rack} is already {color}')
+        if color == self.settings.rgbs[rack][1]:
+            self.logger.info(f'Rack {rack} is already {Payload.rgba(color)}')
             return
 
-        self.last_color = str(rack) + '/' + str(color)
+        with self.color_lock:
+            self.pending_colors[rack] = color
 
-        if not self.currently_listening:
-            self.logger.info('Creating a new rgb thread')
-            self.current_thread = Thread(target=self.rgb_color_thread, args=(rack,))
-            self.currently_listening = True
-            self.current_thread.start()
+            if rack not in self.color_timers:
+                self.logger.info(f'Waiting {self.rgb_debounce}s for rack {rack}\'s color to settle')
+                self.color_timers[rack] = self.clock.timer(self.rgb_debounce, self.rgb_color_settled, (rack,))
     
-    def rgb_color_thread(self, rack):
-        self.logger.info(f'RGB color listener thread started. Listening for rgb rack {rack}')
-        start = time()
-
-        tracking = self.last_color
-
-        while int(time() - start) == 0:
-            if self.last_color[0] != rack:
-                break
-                
-            if tracking != self.last_color:
-                tracking = self.last_color
-        
-        self.logger.info(f'RGB color listener thread ended. Rack {rack}\'s final color {tracking[2:]}')
-        self.currently_listening = False
-        
-        raw_color = tracking[2:]
+    def rgb_color_settled(self, rack):
+        with self.color_lock:
+            # Gone when the connection was released while the timer was due
+            color = self.pending_colors.pop(rack, None)
+            self.color_timers.pop(rack, None)
+
+        if color is None:
+            return
+
+        self.logger.info(f'Rack {rack}\'s final color {Payload.rgba(color)}')
 
-        if self.settings.rgbs[rack][0] == False and raw_color != self.rgb_default:
+        if self.settings.rgbs[rack][0] == False and color != self.rgb_default_color:
             self.antiInterference()
-            self.settings.rgb_color(rack, self.rgb_default)
+            self.settings.rgb_color(rack, self.rgb_default_color)
             self.publish_rgb_color(rack, self.rgb_default)
         else:
-            self.settings.rgb_color(rack, raw_color)
+            self.settings.rgb_color(rack, color)
 
     def publish_led_control(self, shelf, control):
         self.client.publish(self.led_control_topic + shelf, str(control), 0, retain=True)
+        metrics.publishes.inc('led/control')
         self.antiTimeout()
 
     def publish_led_brightness(self, shelf, value):
         self.client.publish(self.led_brightness_topic + shelf, str(value), 0, retain=True)
+        metrics.publishes.inc('led/brightness')
         self.antiTimeout()
 
     def publish_rgb_control(self, rack, control):
         self.client.publish(self.rgb_control_topic + rack, str(control), 0, retain=True)
+        metrics.publishes.inc('rgb/control')
         self.antiTimeout()
 
     def publish_rgb_color(self, rack, color):
         self.client.publish(self.rgb_color_topic + rack, color, 0, retain=True)
+        metrics.publishes.inc('rgb/color')
         self.antiTimeout()
 
     def antiTimeout(self):
-        sleep(0.1)
+        self.clock.sleep(self.anti_timeout)
     
     def antiInterference(self):
-        sleep(0.5)
\ No newline at end of file
+        self.clock.sleep(self.anti_interference)
\ No newline at end of file
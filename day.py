@@ -1,5 +1,4 @@
-from datetime import datetime
-import time
+from clock import Clock
 
 class Day:
 
@@ -13,7 +12,9 @@ class Day:
     #PWM max duty cycle is 4095
     max_duty_cycle = 4095
     
-    def __init__(self):
+    def __init__(self, clock=None):
+        self.clock = clock or Clock()
+
         rise_index = self.sunrise_time.index(":")
         self.sunrise = int(self.sunrise_time[0:rise_index]) * 60 + int(self.sunrise_time[rise_index+1:])
         
@@ -21,12 +22,12 @@ class Day:
         self.sunset = int(self.sunset_time[0:set_index]) * 60 + int(self.sunset_time[set_index+1:])
 
     def isSunrise(self):
-        self.now = datetime.now()
+        self.now = self.clock.now()
         mins_since = self.getMinutesSince(self.sunrise)
         return mins_since >= 0 and mins_since < self.duration
 
     def isSunset(self):
-        self.now = datetime.now()
+        self.now = self.clock.now()
         mins_since = self.getMinutesSince(self.sunset)
         return mins_since >= 0 and mins_since < self.duration
 
@@ -35,7 +36,7 @@ class Day:
     This function will return the brightness depending on which stage it is in. 
     '''
     def getBrightness(self):
-        self.now = datetime.now()
+        self.now = self.clock.now()
 
         #Checks if the current day is in sunrise mode
         if (self.isSunrise()):
@@ -1,6 +1,8 @@
-from Adafruit_PCA9685 import PCA9685
 from schedule import Schedule, Stages
-import sys
+from payload import Payload
+from renderer import Renderer
+from board import Board
+import metrics
 
 class Electronics:
     """
@@ -19,20 +21,54 @@ class Electronics:
         shelf name mapped to pin on pwm module
     rgb_pins : dict
         rack name mapped to pins on pwm module
-    pwm_led, pwm_rgb : PCA9685
-        16 channel pwm module
+    modules : dict
+        Board name mapped to its 16 channel pwm module. Empty when running split
+    renderer : Renderer
+        Separate process driving the pwm modules, when running split
 
     Methods
     -------
     updateModule()
         Refreshes all the shelves with the current light configuration
+    getFrame()
+        Works out the duty cycle of every channel without writing it
+    working()
+        Tells whether any pwm module is taking writes
+    close()
+        Stops the renderer process in split mode
     getBrightness(brightness, scaled)
         Adjusts the brightnesss to match the requirements of PCA9685
     """
 
     MAX_DUTY_CYCLE = 4095
 
-    def __init__(self, logger, settings):
+    # I2C address of each pwm module
+    BOARDS = {'led' : 0x40, 'rgb' : 0x41}
+
+    # Higher the frequency, the smoother the light looks
+    PWM_FREQUENCY = 120
+
+    # Shelf name mapped to its channel on the LED module
+    LED_PINS = {
+        'A1' : 11,
+        'A2' : 10,
+        'A3' : 9,
+        'B1' : 0,
+        'B2' : 1,
+        'B3' : 2,
+        'C1' : 3,
+        'C2' : 4,
+        'C3' : 5
+    }
+
+    # Rack name mapped to its red, green and blue channels on the RGB module
+    RGB_PINS = {
+        'A' : [8, 9, 10],
+        'B' : [0, 1, 2],
+        'C' : [4, 5, 6]
+    }
+
+    def __init__(self, logger, settings, split=False, clock=None, pwms=None, alerts=None, boards=None, renderer=None, times=None, name=None):
         """
         Initializes the LED pin out. Room to change shelf mappings.
         Constructs the 16 bit pwm modules. 
@@ -44,49 +80,64 @@ class Electronics:
             Logs and saves the data seperated by day
         settings : Settings
             Reference to the shelves configuration. Contains LED and RGB configs
+        split : bool
+            Drive the pwm modules from a separate renderer process
+        clock : Clock
+            Time source of the Schedule. The wall clock when None
+        pwms : dict
+            Already opened pwm modules by board name, e.g. for the simulator
+        alerts : Alerts
+            Passed on to the Schedule for its stage change alerts
+        boards : dict
+            I2C address of the 'led' and 'rgb' modules. BOARDS when None
+        renderer : Renderer
+            Renderer process shared with other tanks. Owned by the caller
+        times : FixedTimes, SolarTimes
+            Where the Schedule gets sunrise and sunset from. 07:00 to 19:00 when None
+        name : str
+            Name of the tank. Its boards are labelled e.g. 'A/led' in the metrics. None for the single tank
         """
         self.logger = logger
         self.settings = settings
 
         self.logger.info('Initializing Electronics object')
     
-        self.led_pins = {
-            'A1' : 11,
-            'A2' : 10,
-            'A3' : 9,
-            'B1' : 0,
-            'B2' : 1,
-            'B3' : 2,
-            'C1' : 3,
-            'C2' : 4,
-            'C3' : 5
-        }
+        self.led_pins = dict(self.LED_PINS)
+        self.rgb_pins = dict(self.RGB_PINS)
 
-        self.rgb_pins = {
-            'A' : [8, 9, 10],
-            'B' : [0, 1, 2],
-            'C' : [4, 5, 6]
-        }
+        # Channels dropped by a new pin map. Turned off once on the next update
+        self.released = {'led': set(), 'rgb': set()}
 
         self.logger.debug('LED pin out ' + str(self.led_pins))
         self.logger.debug('RGB pin out ' + str(self.rgb_pins))
 
-        try:
-            self.pwm_led = PCA9685(address=0x40)
-            self.pwm_rgb = PCA9685(address=0x41)
+        self.boards = boards or self.BOARDS
+        self.renderer = renderer
+        self.owns_renderer = False
+        self.modules = {}
 
-            # Higher the frequency, the smoother the light looks
-            self.pwm_led.set_pwm_freq(120)
-            self.pwm_rgb.set_pwm_freq(120)
+        # Same names as the renderer gives the boards of each tank, so tanks do not share a gauge
+        labels = {board: f'{name}/{board}' if name else board for board in ('led', 'rgb')}
 
-            self.logger.info('Initialized the LED and RGB pwm modules')
-        except:
-            self.logger.critical('Unable to access I/O pwm module')
-            self.logger.critical('Electronic initializing failed')
+        if pwms:
+            self.modules = {board: Board(self.logger, labels[board], self.boards[board], self.PWM_FREQUENCY, clock, pwms[board]) for board in ('led', 'rgb')}
+        elif renderer:
+            self.logger.info('Writing the LED and RGB pwm modules through the shared renderer process')
+        elif split:
+            self.logger.info('Handing the LED and RGB pwm modules to a renderer process')
+            self.renderer = Renderer(self.logger, self.boards, self.PWM_FREQUENCY)
+            self.owns_renderer = True
         else:
-            self.logger.info('Electronic Initializing finished')
+            # A board that cannot be opened is parked and retried. The other one still runs
+            self.modules = {board: Board(self.logger, labels[board], self.boards[board], self.PWM_FREQUENCY, clock) for board in ('led', 'rgb')}
+
+            if self.working():
+                self.logger.info('Electronic Initializing finished')
+            else:
+                self.logger.critical('Unable to access I/O pwm module')
+                self.logger.critical('Electronic initializing failed')
 
-        self.schedule = Schedule(logger)
+        self.schedule = Schedule(logger, clock, alerts, times)
 
     def updateModule(self):
         """ Will update each shelf's lights accordingly.
@@ -95,54 +146,142 @@ class Electronics:
         """
 
         try:
-            # The adjusted brightness depending on the current stage of the day
-            percentage = self.schedule.getBrightnessPercentage()
-            brightness = self.getBrightness(self.schedule.getBrightnessPercentage(), 1)
-
-            # Iterates through each available shelf
-            for shelf in self.led_pins.keys():
-
-                # Manual LED override is enabled for the current shelf. Sets the brightnesss to what the user requested
-                if self.settings.leds[shelf][0] == True:
-                    brightness = percentage * self.settings.leds[shelf][1] / 100.0 * self.MAX_DUTY_CYCLE
-                    self.pwm_led.set_pwm(self.led_pins[shelf], 0, int(brightness))
-
-                #In case Rack 3 has rgb priority
-                elif '3' in shelf:
-                    rack = shelf[0]
-                    if self.settings.rgbs[rack][0] == True:
-                        self.pwm_led.set_pwm(self.led_pins[shelf], 0, 0)
-                    else:
-                        brightness = percentage * self.MAX_DUTY_CYCLE
-                        self.pwm_led.set_pwm(self.led_pins[shelf], 0, int(brightness))
-
-                # Stays on default schedule. Follows the sunset and sunrise
+            frame = self.getFrame()
+
+            released = self.released
+            self.released = {'led': set(), 'rgb': set()}
+
+            if self.renderer:
+                # The renderer leaves a channel alone once it is missing from the frame, so it only sees the 0 once
+                self.renderer.write({self.boards[board]: {**dict.fromkeys(released[board], 0), **channels} for board, channels in frame.items()})
+                return True
+
+        except Exception as e:
+            self.logger.critical(f'Unable to update the pwm modules. Exception: {type(e).__name__}: {e}')
+            return False
+
+        # Each board takes its own part of the frame, so one failing board does not stop the other
+        results = [self.modules[board].apply(channels, released[board]) for board, channels in frame.items()]
+        return all(results)
+
+    def getFrame(self):
+        """Works out the duty cycle of every mapped channel
+
+        Returns
+        -------
+        dict
+            Board name mapped to a dict of channel to duty cycle
+        """
+        # A new pin map may be swapped in between two updates. Stick to one for the whole frame
+        led_pins = self.led_pins
+        rgb_pins = self.rgb_pins
+
+        led = {}
+        rgb = {}
+
+        # The adjusted brightness depending on the current stage of the day
+        percentage = self.schedule.getBrightnessPercentage()
+        metrics.schedule_brightness.set(percentage)
+
+        # Iterates through each available shelf
+        for shelf in led_pins.keys():
+
+            # Manual LED override is enabled for the current shelf. Sets the brightnesss to what the user requested
+            if self.settings.leds[shelf][0] == True:
+                brightness = percentage * self.settings.leds[shelf][1] / 100.0 * self.MAX_DUTY_CYCLE
+                led[led_pins[shelf]] = int(brightness)
+
+            #In case Rack 3 has rgb priority
+            elif '3' in shelf:
+                rack = shelf[0]
+                if self.settings.rgbs[rack][0] == True:
+                    led[led_pins[shelf]] = 0
                 else:
                     brightness = percentage * self.MAX_DUTY_CYCLE
-                    self.pwm_led.set_pwm(self.led_pins[shelf], 0, int(brightness))
+                    led[led_pins[shelf]] = int(brightness)
 
-            # Iterates through each available rack
-            for rack in self.rgb_pins.keys():
+            # Stays on default schedule. Follows the sunset and sunrise
+            else:
+                brightness = percentage * self.MAX_DUTY_CYCLE
+                led[led_pins[shelf]] = int(brightness)
 
-                # Manual RGB override is enabled for the current rack, 3rd shelf
-                if self.settings.rgbs[rack][0] == True and self.schedule.stage != Stages.pre_sun_rise and self.schedule.stage != Stages.post_sun_set:
-                    colors = self.settings.rgbs[rack][1]
-                    self.pwm_rgb.set_pwm(self.rgb_pins[rack][0], 0, self.getBrightness(colors[0], 255))
-                    self.pwm_rgb.set_pwm(self.rgb_pins[rack][1], 0, self.getBrightness(colors[1], 255))
-                    self.pwm_rgb.set_pwm(self.rgb_pins[rack][2], 0, self.getBrightness(colors[2], 255))
+        # Iterates through each available rack
+        for rack in rgb_pins.keys():
 
-                # No manual control of rack. Goes back default schedule. i.e off
-                else:
-                    self.pwm_rgb.set_pwm(self.rgb_pins[rack][0], 0, 0)
-                    self.pwm_rgb.set_pwm(self.rgb_pins[rack][1], 0, 0)
-                    self.pwm_rgb.set_pwm(self.rgb_pins[rack][2], 0, 0)
+            # Manual RGB override is enabled for the current rack, 3rd shelf
+            if self.settings.rgbs[rack][0] == True and self.schedule.stage != Stages.pre_sun_rise and self.schedule.stage != Stages.post_sun_set:
+                colors = Payload.unpack(self.settings.rgbs[rack][1])
+                rgb[rgb_pins[rack][0]] = self.getBrightness(colors[0], 255)
+                rgb[rgb_pins[rack][1]] = self.getBrightness(colors[1], 255)
+                rgb[rgb_pins[rack][2]] = self.getBrightness(colors[2], 255)
 
-        except Exception as e:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            self.logger.critical(f'Unable to update the pwm modules. [{exc_type} line # {exc_tb.tb_lineno}]')
-            return False
+            # No manual control of rack. Goes back default schedule. i.e off
+            else:
+                rgb[rgb_pins[rack][0]] = 0
+                rgb[rgb_pins[rack][1]] = 0
+                rgb[rgb_pins[rack][2]] = 0
+
+        return {'led': led, 'rgb': rgb}
+
+    def setPins(self, led_pins, rgb_pins):
+        """Swaps in new pin maps. Channels no longer used are turned off
+        on the next update, the rest simply move
+
+        Parameters
+        ----------
+        led_pins : dict
+            Shelf name mapped to its channel on the LED module
+        rgb_pins : dict
+            Rack name mapped to its 3 channels on the RGB module
+        """
+        old_led = set(self.led_pins.values())
+        old_rgb = set(channel for pins in self.rgb_pins.values() for channel in pins)
+
+        new_led = set(led_pins.values())
+        new_rgb = set(channel for pins in rgb_pins.values() for channel in pins)
+
+        # Adds to what an earlier pin map released, in case no update ran in between
+        self.released = {
+            'led': self.released['led'] | (old_led - new_led),
+            'rgb': self.released['rgb'] | (old_rgb - new_rgb)
+        }
+
+        self.led_pins = dict(led_pins)
+        self.rgb_pins = dict(rgb_pins)
+
+        self.logger.info('LED pin out changed to ' + str(self.led_pins))
+        self.logger.info('RGB pin out changed to ' + str(self.rgb_pins))
+
+    def setFrequency(self, frequency):
+        """Changes the pwm frequency of both modules without turning them off"""
+        if self.renderer:
+            self.renderer.setFrequency(frequency)
+            changed = True
         else:
-            return True
+            changed = all([module.setFrequency(frequency) for module in self.modules.values()])
+
+        if changed:
+            self.logger.info(f'PWM frequency changed to {frequency} Hz')
+        else:
+            self.logger.critical(f'Unable to change the pwm frequency to {frequency} Hz on every module')
+
+    def working(self):
+        """Tells whether at least one pwm module, or the renderer, is taking writes"""
+        if self.renderer:
+            return self.renderer.running()
+        return any(not module.parked for module in self.modules.values())
+
+    def close(self):
+        """Stops the renderer process, if there is one, once it has
+        applied the last frame, and the worker thread of each module
+        """
+        for module in self.modules.values():
+            module.close()
+
+        if self.owns_renderer:
+            self.renderer.stop()
+            self.renderer = None
+            self.owns_renderer = False
 
     def getBrightness(self, brightness, scale):
         """Given raw brightness and the scale, this function will
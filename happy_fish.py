@@ -1,16 +1,28 @@
 from logging.handlers import TimedRotatingFileHandler
 import logging
-from time import sleep
 import pathlib
-from threading import Timer
 from electronics import Electronics
-from settings import Settings
 from connection import Connection, Stage
 from alerts import Alerts
+from tanks import Tank, Hub
+from renderer import Renderer
+from solar import SolarTimes
+from watchdog import Watchdog
+from usage import Usage
+from config import ConfigFile, ConfigError, defaults
+from clock import Clock
+import metrics
+import signal
 import os
 
 class HappyFish():
 
+    # How often the memory, thread and file figures are logged, in seconds
+    REPORT_INTERVAL = 3600
+
+    # Reconnects attempted before giving up on the broker
+    MAX_RECONNECTS = 15
+
     def logSetup (self):
         logger = logging.getLogger('testlog')
         logger.setLevel(logging.DEBUG)
@@ -20,11 +32,13 @@ class HappyFish():
         logger.addHandler(fh)
         return logger
 
-    def __init__(self):
+    def __init__(self, clock=None):
         self.logger = self.logSetup()
+        self.clock = clock or Clock(self.logger)
 
-        alerts = Alerts(self.logger)
-        alerts.alertInfo('Raspberry Pi: Running HappyFish.py')
+        # One alert service for every tank and the connection
+        self.alerts = Alerts(self.logger)
+        self.alerts.alertInfo('Raspberry Pi: Running HappyFish.py')
 
         self.mqtt_email = os.environ["MQTT_EMAIL"]
         self.mqtt_password = os.environ["MQTT_PASSWORD"]
@@ -32,26 +46,76 @@ class HappyFish():
         self.logger.info('='*50)
         self.logger.info('Running main script')
 
-        self.settings = Settings(self.logger, False)
+        self.startMetrics()
+
+        # Setting HAPPYFISH_SPLIT_RENDER=1 moves the pwm writes to their own process
+        split = os.environ.get('HAPPYFISH_SPLIT_RENDER') == '1'
+
+        # Kept apart, so a config file without a schedule section still follows the sun
+        self.env_times = self.solarTimes()
+        times = self.env_times
+
+        # HAPPYFISH_CONFIG points at a JSON config file. config.json is used when it exists
+        path = os.environ.get('HAPPYFISH_CONFIG', 'config.json')
+        self.config_file = ConfigFile(path) if os.environ.get('HAPPYFISH_CONFIG') or os.path.exists(path) else None
+        self.config = defaults()
+        self.next_config_check = 0
+
+        # Setting HAPPYFISH_TANKS runs several tanks from this process, e.g. 'A:0x40:0x41,B:0x42:0x43'
+        tanks = os.environ.get('HAPPYFISH_TANKS')
+        self.renderer = None
+
+        if tanks:
+            boards = Tank.parse(tanks)
+            self.logger.info(f'Running {len(boards)} tanks: {boards}')
+
+            if split:
+                # Every tank shares the one renderer process
+                names = {f'{name}/{board}': address for name in boards for board, address in boards[name].items()}
+                self.renderer = Renderer(self.logger, names, Electronics.PWM_FREQUENCY)
+
+            self.tanks = [Tank(self.logger, name, boards[name], split, self.clock, self.alerts, self.renderer, times) for name in boards]
+        else:
+            self.tanks = [Tank(self.logger, None, None, split, self.clock, self.alerts, None, times)]
+
+        if self.config_file:
+            self.logger.info(f'Reading the config from \'{self.config_file.path}\'')
+            self.reloadConfig()
+
+            # A file with a schedule already said where it comes from when it was applied
+            if self.env_times and not self.config.schedule_set:
+                self.scheduleTimes(self.config)
 
-        self.electronics = Electronics(self.logger, self.settings)
+        self.watchdog = Watchdog(self.logger)
+        self.toggle_profiler = False
+
+        # Setting HAPPYFISH_TRACEMALLOC=1 adds the top allocating lines to the self report
+        self.usage = Usage(os.environ.get('HAPPYFISH_TRACEMALLOC') == '1')
+        self.next_report = 0
+
+        # kill -USR1 <pid> switches the sampling profiler on and off
+        signal.signal(signal.SIGUSR1, self.onProfilerSignal)
 
         self.logger.info('Updating the pwm modules for the first time')
-        self.result = self.electronics.updateModule()
+        self.result = self.tick('first update')
 
         self.reconnect_count = 0
         self.reconnect_delay = 60
 
         if self.result == True:
             self.logger.info('PWM modules updated. Electronics working as intended')
+        elif any(tank.electronics.working() for tank in self.tanks):
+            # A parked module is retried in the background while the rest of the lights run
+            self.logger.critical('Some pwm modules did not answer. Running with the rest and retrying them')
+            self.alerts.alertCritical('Raspberry Pi: a PWM Module is not answering. Retrying it in the background')
         else:
             self.logger.critical('Failed to light up the lab room. Check pwm modules')
             self.logger.critical('Terminating script. Please check hardware')
-            alerts = Alerts(self.logger)
-            alerts.alertCritical('Raspberry Pi: PWM Module cannot be opened')
+            self.alerts.alertCritical('Raspberry Pi: PWM Module cannot be opened')
+            self.closeElectronics()
             exit()
 
-        self.connection = Connection(self.logger, self.settings, self.mqtt_email, self.mqtt_password)
+        self.connection = self.newConnection()
         self.connection.start(self)
         self.reconnecting = False
 
@@ -59,43 +123,176 @@ class HappyFish():
         try:
             self.logger.info('Running main loop')
             while True:
-                sleep(0.5)
+                self.clock.sleep(0.5)
+
+                self.tick('update')
+
+                metrics.reconnects.set(self.reconnect_count)
+                metrics.reconnect_delay.set(self.reconnect_delay)
+
+                if self.config_file and self.clock.monotonic() >= self.next_config_check:
+                    self.next_config_check = self.clock.monotonic() + ConfigFile.POLL_INTERVAL
+                    if self.config_file.changed():
+                        self.reloadConfig()
+
+                if self.clock.monotonic() >= self.next_report:
+                    self.next_report = self.clock.monotonic() + self.REPORT_INTERVAL
+                    self.selfReport()
 
-                self.electronics.updateModule()
+                if self.toggle_profiler:
+                    self.toggle_profiler = False
+                    self.watchdog.toggleProfiler()
 
-                if not self.reconnecting and self.connection.connection_closed and self.reconnect_count < 15:
-                    self.logger.critical(f'Connection appears to be closed... Ending connection and will reconnect after {self.reconnect_delay/60} min(s)')
-                    alerts = Alerts(self.logger)
-                    alerts.alertCritical(f'Connection appears to be closed. Reconnecting again in {self.reconnect_delay/60} min(s). Reconnect count is {self.reconnect_count}')
-                    self.connection.end()
-                    self.reconnecting = True
-                    self.timer = Timer(self.reconnect_delay, self.reconnect, args=None, kwargs=None)
-                    self.timer.start()
+                self.checkConnection()
 
         except KeyboardInterrupt:
             self.logger.critical('Script manually terminated')
 
         self.connection.end()
 
-        self.settings.printConfig()
+        for tank in self.tanks:
+            tank.settings.printConfig()
 
         self.logger.info('Script ended. Shutting down the lights')
-        self.settings.turnAllOff()
-        self.result = self.electronics.updateModule()
+        for tank in self.tanks:
+            tank.settings.turnAllOff()
+        self.result = self.tick('shutdown')
 
         if self.result == True:
             self.logger.info('Successfully turned off all the lights')
         else:
             self.logger.critical('Failed to turn off the lights. Unable to communicate with pwm module')
 
-        alerts = Alerts(self.logger)
-        alerts.alertCritical('HappyFish script got terminated... Unknown reason')
+        self.closeElectronics()
+
+        self.alerts.alertCritical('HappyFish script got terminated... Unknown reason')
+
+        self.watchdog.stop()
 
         self.ended = True
+
+    def checkConnection(self):
+        if not self.reconnecting and self.connection.connection_closed and self.reconnect_count < self.MAX_RECONNECTS:
+            self.logger.critical(f'Connection appears to be closed... Ending connection and will reconnect after {self.reconnect_delay/60} min(s)')
+            self.alerts.alertCritical(f'Connection appears to be closed. Reconnecting again in {self.reconnect_delay/60} min(s). Reconnect count is {self.reconnect_count}')
+            self.connection.end()
+            self.reconnecting = True
+            self.timer = self.clock.timer(self.reconnect_delay, self.reconnect)
+
+    def tick(self, name):
+        self.watchdog.begin(name)
+        try:
+            # Every tank is written from this one loop, one after the other
+            results = [tank.electronics.updateModule() for tank in self.tanks]
+            return all(results)
+        finally:
+            metrics.tick_seconds.observe(self.watchdog.end())
+
+    def selfReport(self):
+        self.logger.info('Self report: ' + Usage.describe(self.usage.sample()))
+        for line in self.usage.topAllocators():
+            self.logger.info('Top allocator: ' + line)
+
+    def reloadConfig(self):
+        try:
+            config = self.config_file.load()
+        except ConfigError as e:
+            self.logger.critical(f'Config not applied, keeping the running one. {e}')
+            self.alerts.alertCritical(f'Raspberry Pi: config file rejected. {e}')
+            return
+
+        self.applyConfig(config)
+
+    def applyConfig(self, config):
+        # Runs between two ticks, so nothing is half way through a frame. Only the sections that changed are redone
+        old = self.config
+        self.config = config
+
+        # Adding or removing the section decides between the file and HAPPYFISH_LATITUDE, even with the same times
+        if config.schedule != old.schedule or config.schedule_set != old.schedule_set:
+            self.logger.info('Schedule config changed')
+            times = self.scheduleTimes(config)
+            for tank in self.tanks:
+                tank.electronics.schedule.setTimes(times)
+
+        if config.pwm.frequency != old.pwm.frequency:
+            for tank in self.tanks:
+                tank.electronics.setFrequency(config.pwm.frequency)
+
+        if config.pwm.led_pins != old.pwm.led_pins or config.pwm.rgb_pins != old.pwm.rgb_pins:
+            for tank in self.tanks:
+                tank.electronics.setPins(config.pwm.led_pins, config.pwm.rgb_pins)
+
+        if config.mqtt != old.mqtt and hasattr(self, 'connection'):
+            self.connection.configure(config.mqtt)
+
+    def scheduleTimes(self, config):
+        # HAPPYFISH_LATITUDE and HAPPYFISH_LONGITUDE only give way to a file that sets its own schedule
+        if self.env_times is None:
+            return config.times
+
+        if not config.schedule_set:
+            self.logger.info('Schedule follows HAPPYFISH_LATITUDE and HAPPYFISH_LONGITUDE. The config file does not set one')
+            return self.env_times
+
+        self.logger.warning('Schedule comes from the config file. It overrides HAPPYFISH_LATITUDE and HAPPYFISH_LONGITUDE')
+        return config.times
+
+    def startMetrics(self):
+        # Metrics are always collected. Exporting them is opt-in
+        port = os.environ.get('HAPPYFISH_METRICS_PORT')
+        path = os.environ.get('HAPPYFISH_METRICS_FILE')
+
+        try:
+            if port:
+                metrics.registry.serve(self.logger, int(port), os.environ.get('HAPPYFISH_METRICS_ADDRESS', '127.0.0.1'))
+            if path:
+                metrics.registry.dumpForever(self.logger, path)
+        except Exception as e:
+            self.logger.critical(f'Unable to export metrics. Exception: {e}')
+
+    def solarTimes(self):
+        # Setting HAPPYFISH_LATITUDE and HAPPYFISH_LONGITUDE follows the real sun instead of 07:00 to 19:00.
+        # HAPPYFISH_PHOTOPERIOD, e.g. '8:12', keeps the day between 8 and 12 hours long
+        latitude = os.environ.get('HAPPYFISH_LATITUDE')
+        longitude = os.environ.get('HAPPYFISH_LONGITUDE')
+        if not latitude or not longitude:
+            return None
+
+        min_hours = max_hours = None
+        photoperiod = os.environ.get('HAPPYFISH_PHOTOPERIOD')
+        if photoperiod:
+            min_hours, max_hours = [float(hours) for hours in photoperiod.split(':')]
+
+        return SolarTimes(float(latitude), float(longitude), min_hours=min_hours, max_hours=max_hours)
+
+    def newConnection(self):
+        if self.tanks[0].name is None:
+            connection = Connection(self.logger, self.tanks[0].settings, self.mqtt_email, self.mqtt_password, self.clock)
+        else:
+            connection = Hub(self.logger, self.tanks, self.mqtt_email, self.mqtt_password, self.clock)
+
+        connection.configure(self.config.mqtt)
+        return connection
+
+    def closeElectronics(self):
+        for tank in self.tanks:
+            tank.electronics.close()
+        if self.renderer:
+            self.renderer.stop()
+
+    def onProfilerSignal(self, signum, frame):
+        # Only flag it here. The main loop does the work outside the signal handler
+        self.toggle_profiler = True
     
     def reconnect(self):
         self.logger.critical('Attempting to reconnect again')
-        self.connection = Connection(self.logger, self.settings, self.mqtt_email, self.mqtt_password)
+
+        # The old client is done with. Let it go rather than keep one per reconnect
+        old = self.connection
+        self.connection = self.newConnection()
+        old.release()
+
         self.connection.start(self)
         self.reconnecting = False
         self.reconnect_count = self.reconnect_count + 1
\ No newline at end of file
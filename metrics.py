@@ -0,0 +1,217 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+from time import sleep
+import os
+
+class Metric:
+    """
+    Base of every metric. Values are kept per tuple of label values
+
+    ...
+
+    Attributes
+    ----------
+    name : str
+        Prometheus name of the metric
+    help : str
+        One line description shown in the export
+    labels : tuple
+        Names of the labels, in the order their values are passed
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = Lock()
+        self.values = {}
+
+    def labelText(self, values, extra=''):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            for values, value in self.values.items():
+                lines.append(f'{self.name}{self.labelText(values)} {value}')
+        return lines
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    # Upper bounds in seconds. Sized for ticks, handlers and I2C writes
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * len(self.BUCKETS), 0, 0.0]
+
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+
+            entry[1] += 1
+            entry[2] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            for values, (buckets, count, total) in self.values.items():
+                cumulative = 0
+                for bound, hits in zip(self.BUCKETS, buckets):
+                    cumulative += hits
+                    bucket = self.labelText(values, 'le="' + str(bound) + '"')
+                    lines.append(f'{self.name}_bucket{bucket} {cumulative}')
+                bucket = self.labelText(values, 'le="+Inf"')
+                lines.append(f'{self.name}_bucket{bucket} {count}')
+                lines.append(f'{self.name}_sum{self.labelText(values)} {total}')
+                lines.append(f'{self.name}_count{self.labelText(values)} {count}')
+        return lines
+
+class Registry:
+    """
+    Holds every metric of the controller and exports them
+
+    ...
+
+    Updating a metric is a dict update under a lock, so it is cheap enough
+    for the hot paths and is always on. Exporting is opt-in through the
+    environment variables read by HappyFish:
+
+        HAPPYFISH_METRICS_PORT      serve /metrics on this port
+        HAPPYFISH_METRICS_ADDRESS   address to bind, 127.0.0.1 by default
+        HAPPYFISH_METRICS_FILE      rewrite this file every DUMP_INTERVAL
+
+    Both use the Prometheus text format.
+    """
+
+    # How often the metrics file is rewritten, in seconds
+    DUMP_INTERVAL = 15
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=()):
+        return self.add(Histogram(name, help, labels))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, logger, port, address='127.0.0.1'):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, args=(), name='metrics', daemon=True).start()
+        logger.info(f'Serving metrics on http://{address}:{port}/metrics')
+
+    def dumpForever(self, logger, path):
+        logger.info(f'Writing metrics to \'{path}\' every {self.DUMP_INTERVAL}s')
+        Thread(target=self.dumpLoop, args=(logger, path), name='metrics-dump', daemon=True).start()
+
+    def dumpLoop(self, logger, path):
+        while True:
+            sleep(self.DUMP_INTERVAL)
+            try:
+                self.dump(path)
+            except OSError as e:
+                logger.critical(f'Unable to write metrics to \'{path}\'. Exception: {e}')
+
+    def dump(self, path):
+        # Written aside and renamed so readers never see a half written file
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(self.render())
+        os.replace(temp, path)
+
+registry = Registry()
+
+tick_seconds = registry.histogram('happyfish_tick_seconds', 'Time taken by each update of the pwm modules')
+tick_overruns = registry.counter('happyfish_tick_overruns_total', 'Updates that ran past the watchdog deadline')
+
+i2c_writes = registry.counter('happyfish_i2c_writes_total', 'PWM channel writes sent to a board', ('board',))
+i2c_failures = registry.counter('happyfish_i2c_failures_total', 'PWM channel writes that raised', ('board',))
+board_parked = registry.gauge('happyfish_board_parked', 'Set to 1 while a board is parked by its circuit breaker', ('board',))
+board_asleep = registry.gauge('happyfish_board_asleep', 'Set to 1 while a board is in low power sleep', ('board',))
+board_recoveries = registry.counter('happyfish_board_recoveries_total', 'Parked boards that came back', ('board',))
+
+messages = registry.counter('happyfish_mqtt_messages_total', 'MQTT messages received per connection stage', ('stage',))
+handler_seconds = registry.histogram('happyfish_mqtt_handler_seconds', 'Time spent handling a MQTT message', ('stage',))
+publishes = registry.counter('happyfish_mqtt_publishes_total', 'Retained messages published back to the broker', ('topic',))
+reconnects = registry.gauge('happyfish_mqtt_reconnects', 'Reconnects attempted since start')
+reconnect_delay = registry.gauge('happyfish_mqtt_reconnect_delay_seconds', 'Current delay before the next reconnect')
+
+alerts_pending = registry.gauge('happyfish_alerts_pending', 'Alerts currently being sent')
+alerts_sent = registry.counter('happyfish_alerts_total', 'Alerts sent per level', ('level',))
+
+schedule_stage = registry.gauge('happyfish_schedule_stage', 'Set to 1 for the current scheduled stage', ('stage',))
+schedule_brightness = registry.gauge('happyfish_schedule_brightness', 'Scheduled brightness between 0 and 1')
+
+resident_bytes = registry.gauge('happyfish_resident_bytes', 'Resident memory of the process')
+threads = registry.gauge('happyfish_threads', 'Threads alive in the process')
+open_files = registry.gauge('happyfish_open_files', 'File descriptors open in the process')
+traced_bytes = registry.gauge('happyfish_traced_bytes', 'Memory allocated by Python, when tracemalloc is on')
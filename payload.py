@@ -0,0 +1,86 @@
+from functools import lru_cache
+import re
+
+class Payload:
+    """
+    Decodes raw MQTT payloads straight from bytes
+
+    ...
+
+    Colours are kept as packed integers 0xRRGGBB. The following
+    payloads are understood for a colour topic:
+
+        RGBA(r,g,b, a)  the text sent by the mobile app
+        #rrggbb         compact hex text
+        3 raw bytes     r, g, b
+        4 raw bytes     r, g, b, a
+
+    Alpha is accepted but ignored, same as before. The short #rgb hex
+    form is not supported. It is rejected rather than read as 4 raw
+    bytes.
+
+    Methods
+    -------
+    text(payload)
+        Returns the payload as a string
+    color(payload)
+        Returns the packed colour of a payload
+    unpack(color)
+        Splits a packed colour into its red, green and blue values
+    rgba(color)
+        Formats a packed colour the same way the app does
+    """
+
+    # How many distinct colour payloads are remembered
+    CACHE_SIZE = 64
+
+    @staticmethod
+    def text(payload):
+        if isinstance(payload, str):
+            return payload
+        return payload.decode('utf-8', 'replace')
+
+    @staticmethod
+    def color(payload):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        return _parse_color(bytes(payload))
+
+    @staticmethod
+    def unpack(color):
+        return (color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF
+
+    @staticmethod
+    def rgba(color):
+        r, g, b = Payload.unpack(color)
+        return f'RGBA({r},{g},{b}, 255)'
+
+HEX_COLOR = re.compile(rb'#[0-9a-fA-F]{6}')
+SHORT_HEX_COLOR = re.compile(rb'#[0-9a-fA-F]{3}')
+
+@lru_cache(maxsize=Payload.CACHE_SIZE)
+def _parse_color(payload):
+    size = len(payload)
+
+    # Text first, so '#fff' is not taken for 4 raw bytes
+    if HEX_COLOR.fullmatch(payload):
+        return int(payload[1:], 16)
+
+    if SHORT_HEX_COLOR.fullmatch(payload):
+        raise ValueError(f'Short hex colour payload {payload!r} is not supported. Use #rrggbb')
+
+    if size == 3 or size == 4:
+        return (payload[0] << 16) | (payload[1] << 8) | payload[2]
+
+    if payload[:5] == b'RGBA(' and payload[-1:] == b')':
+        values = payload[5:-1].split(b',')
+        if len(values) != 4:
+            raise ValueError(f'Expected 4 values in colour payload {payload!r}')
+
+        r, g, b = int(values[0]), int(values[1]), int(values[2])
+        if not (0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255):
+            raise ValueError(f'Colour out of range in payload {payload!r}')
+
+        return (r << 16) | (g << 8) | b
+
+    raise ValueError(f'Unknown colour payload {payload!r}')
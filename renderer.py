@@ -0,0 +1,305 @@
+from logging.handlers import TimedRotatingFileHandler
+from multiprocessing import Process, Event, parent_process
+from multiprocessing.shared_memory import SharedMemory
+from time import sleep, monotonic
+import logging
+import pathlib
+from board import Board
+import metrics
+
+class FrameBuffer:
+    """
+    Target duty cycles of every pwm channel, kept in shared memory
+
+    ...
+
+    The layout is a header of unsigned 32 bit ints followed by 16 unsigned
+    16 bit duty cycles per board. Channels no shelf is mapped to hold UNSET
+    and are never written.
+
+    The control process is the only writer. It follows a sequence lock:
+    the sequence is made odd, the values are written, then it is made even
+    again. A reader retries until it sees the same even sequence before
+    and after copying the values. The control process writes a full frame
+    every tick, so any value read out of order is corrected on the next one.
+
+    Attributes
+    ----------
+    boards : list
+        I2C addresses of the boards, in the order they are laid out
+    header : memoryview
+        SEQUENCE, APPLIED, STATUS, FREQUENCY, then writes, failures and parked of each board
+    values : memoryview
+        CHANNELS duty cycles per board
+    """
+
+    CHANNELS = 16
+    UNSET = 0xFFFF
+
+    # Header fields
+    SEQUENCE = 0
+    APPLIED = 1
+    STATUS = 2
+    FREQUENCY = 3
+    COUNTERS = 4
+
+    # Fields per board after COUNTERS
+    BOARD_FIELDS = 3
+
+    # Values of the STATUS field
+    STARTING = 0
+    READY = 1
+    FAILED = 2
+
+    def __init__(self, boards, name=None):
+        self.boards = boards
+
+        header_size = self.COUNTERS + self.BOARD_FIELDS * len(boards)
+        size = header_size * 4 + len(boards) * self.CHANNELS * 2
+
+        self.owner = name is None
+        self.shm = SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.name = self.shm.name
+
+        self.header = self.shm.buf[:header_size * 4].cast('I')
+        self.values = self.shm.buf[header_size * 4:size].cast('H')
+
+        if self.owner:
+            for i in range(len(self.header)):
+                self.header[i] = 0
+            for i in range(len(self.values)):
+                self.values[i] = self.UNSET
+
+    def write(self, frame):
+        sequence = self.header[self.SEQUENCE]
+        self.header[self.SEQUENCE] = (sequence + 1) & 0xFFFFFFFF
+
+        for i, board in enumerate(self.boards):
+            channels = frame.get(board, {})
+            base = i * self.CHANNELS
+            for channel in range(self.CHANNELS):
+                self.values[base + channel] = channels.get(channel, self.UNSET)
+
+        self.header[self.SEQUENCE] = (sequence + 2) & 0xFFFFFFFF
+        return (sequence + 2) & 0xFFFFFFFF
+
+    def read(self):
+        while True:
+            before = self.header[self.SEQUENCE]
+            if before & 1:
+                sleep(0)
+                continue
+
+            values = self.values.tolist()
+
+            if self.header[self.SEQUENCE] == before:
+                return before, values
+
+    def counters(self, index):
+        base = self.COUNTERS + self.BOARD_FIELDS * index
+        return tuple(self.header[base:base + self.BOARD_FIELDS])
+
+    def report(self, index, writes, failures, parked):
+        base = self.COUNTERS + self.BOARD_FIELDS * index
+        self.header[base] = writes & 0xFFFFFFFF
+        self.header[base + 1] = failures & 0xFFFFFFFF
+        self.header[base + 2] = int(parked)
+
+    def close(self):
+        self.header.release()
+        self.values.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class Renderer:
+    """
+    Runs the pwm modules from a separate process
+
+    ...
+
+    Only the renderer process talks to the PCA9685 boards. The control
+    process (Connection, Settings, Schedule) computes a frame each tick and
+    writes it to the FrameBuffer, so MQTT traffic, alerts and logging in
+    the control process no longer delay the I2C writes. Enabled by setting
+    HAPPYFISH_SPLIT_RENDER=1.
+
+    Several Electronics can share one renderer, each writing the boards
+    it owns. The latest frame of every board is kept and written together.
+
+    Methods
+    -------
+    write(frame)
+        Hands a frame of {address: {channel: duty cycle}} to the renderer
+    setFrequency(frequency)
+        Changes the pwm frequency of every board on the next frame
+    stop()
+        Waits for the last frame to be applied and stops the process
+    """
+
+    # Longest to wait for the renderer to start, in seconds. Each board it opens may add Board.INIT_TIMEOUT
+    START_TIMEOUT = 5
+
+    # Longest to wait for the last frame when stopping, in seconds
+    STOP_TIMEOUT = 2
+
+    def __init__(self, logger, boards, frequency):
+        """
+        Parameters
+        ----------
+        logger : Logger
+            Logs and saves the data seperated by day
+        boards : dict
+            Board name mapped to its I2C address
+        frequency : int
+            PWM frequency of every board, in hertz
+        """
+        self.logger = logger
+        self.names = list(boards.keys())
+        self.addresses = list(boards.values())
+
+        self.frame_buffer = FrameBuffer(self.addresses)
+        self.staged = {}
+        self.frame_ready = Event()
+        self.stopping = Event()
+
+        self.collected = [(0, 0)] * len(self.names)
+        self.frame_buffer.header[FrameBuffer.FREQUENCY] = frequency
+
+        self.process = Process(target=render, args=(self.frame_buffer.name, boards, frequency, self.frame_ready, self.stopping), name='renderer', daemon=True)
+        self.process.start()
+
+        self.logger.info(f'Started renderer process {self.process.pid}')
+
+        started = monotonic()
+        timeout = self.START_TIMEOUT + Board.INIT_TIMEOUT * len(boards)
+        while self.frame_buffer.header[FrameBuffer.STATUS] == FrameBuffer.STARTING and monotonic() - started < timeout:
+            sleep(0.05)
+
+        if self.frame_buffer.header[FrameBuffer.STATUS] != FrameBuffer.READY:
+            self.logger.critical('Renderer process could not open any pwm module. See logs/Renderer.log')
+
+    def running(self):
+        return self.frame_buffer.header[FrameBuffer.STATUS] == FrameBuffer.READY and self.process.is_alive()
+
+    def write(self, frame):
+        if not self.running():
+            raise RuntimeError('Renderer process is not running')
+
+        self.staged.update(frame)
+        sequence = self.frame_buffer.write(self.staged)
+        self.frame_ready.set()
+        self.collect()
+        return sequence
+
+    def setFrequency(self, frequency):
+        self.frame_buffer.header[FrameBuffer.FREQUENCY] = int(frequency)
+        self.frame_ready.set()
+
+    def collect(self):
+        # The renderer counts its own writes. Carry them over to our metrics
+        for i, board in enumerate(self.names):
+            writes, failures, parked = self.frame_buffer.counters(i)
+            metrics.board_parked.set(parked, board)
+            last_writes, last_failures = self.collected[i]
+            if writes != last_writes:
+                metrics.i2c_writes.inc(board, amount=(writes - last_writes) & 0xFFFFFFFF)
+            if failures != last_failures:
+                metrics.i2c_failures.inc(board, amount=(failures - last_failures) & 0xFFFFFFFF)
+            self.collected[i] = (writes, failures)
+
+    def stop(self):
+        sequence = self.frame_buffer.header[FrameBuffer.SEQUENCE]
+
+        started = monotonic()
+        while self.process.is_alive() and self.frame_buffer.header[FrameBuffer.APPLIED] != sequence and monotonic() - started < self.STOP_TIMEOUT:
+            sleep(0.01)
+
+        self.stopping.set()
+        self.frame_ready.set()
+        self.process.join(self.STOP_TIMEOUT)
+
+        if self.process.is_alive():
+            self.logger.critical('Renderer process did not stop. Terminating it')
+            self.process.terminate()
+
+        self.collect()
+        self.frame_buffer.close()
+        self.logger.info('Renderer process stopped')
+
+def render(name, boards, frequency, frame_ready, stopping):
+    """Entry point of the renderer process. Applies each new frame through
+    a Board per address, so every board writes only what changed and is
+    parked, probed and replayed on its own. Only stops at start when no
+    board can be opened.
+    """
+    logger = logging.getLogger('renderer')
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(fmt='%(asctime)s [%(filename)-15s %(lineno)-4s %(funcName)15s()] %(levelname)-8s %(message)s', datefmt='%m-%d-%y %H:%M:%S')
+    fh = TimedRotatingFileHandler(str(pathlib.Path().absolute())+'/logs/Renderer.log', when='midnight', interval=1)
+    fh.setFormatter(formatter)
+    logger.addHandler(fh)
+
+    frame_buffer = FrameBuffer(list(boards.values()), name)
+
+    # Each board is opened, parked and probed on its own, as in the control process. One failing board leaves the rest running
+    modules = [Board(logger, board, address, frequency) for board, address in boards.items()]
+    report(frame_buffer, modules)
+
+    if all(module.parked for module in modules):
+        logger.critical('Unable to access any I/O pwm module')
+        frame_buffer.header[FrameBuffer.STATUS] = FrameBuffer.FAILED
+        close(frame_buffer, modules)
+        return
+
+    logger.info(f'Renderer process started with boards {boards}')
+    frame_buffer.header[FrameBuffer.STATUS] = FrameBuffer.READY
+
+    parent = parent_process()
+
+    while not stopping.is_set():
+
+        # Wakes up at least once a second to notice a dead control process
+        if not frame_ready.wait(1):
+            if parent is not None and not parent.is_alive():
+                logger.critical('Control process is gone. Stopping renderer')
+                break
+            continue
+
+        frame_ready.clear()
+        sequence, values = frame_buffer.read()
+
+        # The control process can change the frequency while running. The duty cycles are kept
+        if frame_buffer.header[FrameBuffer.FREQUENCY] != frequency:
+            frequency = frame_buffer.header[FrameBuffer.FREQUENCY]
+            for module in modules:
+                module.setFrequency(frequency)
+            logger.info(f'PWM frequency changed to {frequency} Hz')
+
+        for i, module in enumerate(modules):
+            base = i * FrameBuffer.CHANNELS
+            frame = {channel: values[base + channel] for channel in range(FrameBuffer.CHANNELS) if values[base + channel] != FrameBuffer.UNSET}
+
+            # Nothing was written for this board yet. Leaves it alone rather than taking it for a dark frame
+            if frame:
+                module.apply(frame)
+
+        report(frame_buffer, modules)
+        frame_buffer.header[FrameBuffer.APPLIED] = sequence
+
+    close(frame_buffer, modules)
+    logger.info('Renderer process ended')
+
+def report(frame_buffer, modules):
+    """Hands the write counts and breaker state each Board keeps in this
+    process's metrics over to the control process
+    """
+    for i, module in enumerate(modules):
+        writes = metrics.i2c_writes.values.get((module.name,), 0)
+        failures = metrics.i2c_failures.values.get((module.name,), 0)
+        frame_buffer.report(i, writes, failures, module.parked)
+
+def close(frame_buffer, modules):
+    for module in modules:
+        module.close()
+    frame_buffer.close()
@@ -1,5 +1,6 @@
-from datetime import datetime
 from alerts import Alerts
+from clock import Clock
+import metrics
 
 class Stages:
     pre_sun_rise = 'PRE Sun-Rise'
@@ -8,6 +9,28 @@ class Stages:
     sun_set = 'Sun-Set'
     post_sun_set = 'POST Sun-Set'
 
+class FixedTimes:
+    """Same sunrise and sunset every day. Both are when their ramp starts"""
+
+    def __init__(self, sunrise, sunset, duration):
+        self.sunrise = sunrise
+        self.sunset = sunset
+        self.duration = duration
+
+        index = sunrise.index(':')
+        sunrise_start = (int(sunrise[:index]) * 3600) + (int(sunrise[index+1:]) * 60)
+
+        index = sunset.index(':')
+        sunset_start = (int(sunset[:index]) * 3600) + (int(sunset[index+1:]) * 60)
+
+        self.times = [sunrise_start, sunset_start, duration * 60]
+
+    def getTimes(self, date):
+        return self.times
+
+    def describe(self):
+        return 'Sunrise is set to '+self.sunrise+'. Sunset is set to '+self.sunset+'. Duration of each stage is set to '+str(self.duration)+' minutes'
+
 class Schedule:
 
     #Set the sunrise and sunset time in 24 hour format
@@ -17,28 +40,31 @@ class Schedule:
     #The duration of sunset/sunrise in minutes
     duration = 30
 
-    def __init__(self, logger):
-        index = self.sunrise.index(':')
-        self.sunrise_start = (int(self.sunrise[:index]) * 3600) + (int(self.sunrise[index+1:]) * 60)
-        
-        index = self.sunset.index(':')
-        self.sunset_start = (int(self.sunset[:index]) * 3600) + (int(self.sunset[index+1:]) * 60)
+    def __init__(self, logger, clock=None, alerts=None, times=None):
+        self.logger = logger
+        self.clock = clock or Clock()
 
-        self.duration_seconds = self.duration * 60
+        # Sends the stage change alerts. Made on the first stage change when None
+        self.alerts = alerts
 
-        self.logger = logger
+        # Where sunrise and sunset come from. Asked once per calendar day
+        self.times = times or FixedTimes(self.sunrise, self.sunset, self.duration)
+        self.times_date = None
 
-        self.logger.info('Sunrise is set to '+self.sunrise+'. Sunset is set to '+self.sunset)
-        self.logger.info('Duration of each stage is set to '+str(self.duration)+' minutes')
+        self.logger.info(self.times.describe())
 
         self.stage = self.getStageInfo()[0]
         self.logger.debug('Initialization stage \''+self.stage+'\'')
+        self.updateMetrics()
 
     def getStageInfo(self):
 
-        now = datetime.now()
+        now = self.clock.now()
         seconds = (now.hour * 3600) + (now.minute * 60) + (now.second)
 
+        if now.date() != self.times_date:
+            self.updateTimes(now.date())
+
         if seconds < self.sunrise_start:
             return [Stages.pre_sun_rise, seconds]
 
@@ -63,9 +89,11 @@ class Schedule:
 
         if current_stage != self.stage:
             self.logger.info('Scheduled stage changed from \''+self.stage+'\' to \''+current_stage+'\'')
-            alerts = Alerts(self.logger)
-            alerts.alertInfo('Scheduled stage changed from \''+self.stage+'\' to \''+current_stage+'\'')
+            if self.alerts is None:
+                self.alerts = Alerts(self.logger)
+            self.alerts.alertInfo('Scheduled stage changed from \''+self.stage+'\' to \''+current_stage+'\'')
             self.stage = current_stage
+            self.updateMetrics()
         
         if self.stage == Stages.pre_sun_rise or self.stage == Stages.post_sun_set:
             return 0.0
@@ -76,4 +104,34 @@ class Schedule:
         if self.stage == Stages.sun_set:
             return 1 - (float(seconds - self.sunset_start) / float(self.duration_seconds))
         
-        return 1.0
\ No newline at end of file
+        return 1.0
+
+    def setTimes(self, times):
+        # Worked out again on the next tick. The ramp carries on from wherever the new times put it
+        self.times = times
+        self.times_date = None
+        self.logger.info(self.times.describe())
+
+    def updateTimes(self, date):
+        self.sunrise_start, self.sunset_start, self.duration_seconds = self.times.getTimes(date)
+        self.times_date = date
+
+        if self.sunrise_start >= 86400:
+            self.logger.info(f'Schedule for {date}: dark all day')
+            return
+        if self.sunrise_start + self.duration_seconds <= 0 and self.sunset_start >= 86400:
+            self.logger.info(f'Schedule for {date}: lights on all day')
+            return
+
+        # Logged as the ramps, whether the times are fixed or follow the sun
+        self.logger.info(f'Schedule for {date}: sunrise ramp {self.clockTime(self.sunrise_start)} to {self.clockTime(self.sunrise_start + self.duration_seconds)}, '
+                         f'sunset ramp {self.clockTime(self.sunset_start)} to {self.clockTime(self.sunset_start + self.duration_seconds)}')
+
+    @staticmethod
+    def clockTime(seconds):
+        minutes = min(max(seconds, 0), 86400) // 60
+        return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+    def updateMetrics(self):
+        for stage in (Stages.pre_sun_rise, Stages.sun_rise, Stages.lights_on, Stages.sun_set, Stages.post_sun_set):
+            metrics.schedule_stage.set(1 if stage == self.stage else 0, stage)
\ No newline at end of file
@@ -1,3 +1,4 @@
+from payload import Payload
 
 class Settings:
     
@@ -27,10 +28,11 @@ class Settings:
             'C3' : [False, 0]
         }
 
+        # Colours are packed as 0xRRGGBB
         self.rgbs = {
-            'A' : [False, [0, 0, 0], 'RGBA(0,0,0, 255)'],
-            'B' : [False, [0, 0, 0], 'RGBA(0,0,0, 255)'],
-            'C' : [False, [0, 0, 0], 'RGBA(0,0,0, 255)']
+            'A' : [False, 0x000000],
+            'B' : [False, 0x000000],
+            'C' : [False, 0x000000]
         }
 
         if not dummy:
@@ -60,13 +62,9 @@ class Settings:
         self.logger.debug(self.dummy_str+'Rack ['+rack+'] control changed from \''+str(before)+'\' to \''+str(control)+'\'')
 
     def rgb_color(self, rack, color):
-        before = self.rgbs[rack][1].copy()
-        formatted = color[5:len(color)-1].split(",")
-        self.rgbs[rack][1][0] = int(formatted[0])
-        self.rgbs[rack][1][1] = int(formatted[1])
-        self.rgbs[rack][1][2] = int(formatted[2])
-        self.rgbs[rack][2] = color
-        self.logger.debug(self.dummy_str+'Rack ['+rack+'] color changed from \''+str(before)+'\' to \''+str(self.rgbs[rack][1])+'\'')
+        before = self.rgbs[rack][1]
+        self.rgbs[rack][1] = color
+        self.logger.debug(self.dummy_str+'Rack ['+rack+'] color changed from \''+Payload.rgba(before)+'\' to \''+Payload.rgba(color)+'\'')
 
     def printConfig(self):
         self.logger.debug(self.dummy_str+'LEDs config '+str(self.leds))
@@ -0,0 +1,176 @@
+from datetime import datetime, timedelta
+from time import perf_counter, process_time
+import argparse
+import logging
+import csv
+import sys
+from clock import VirtualClock
+from settings import Settings
+from electronics import Electronics
+from solar import SolarTimes
+
+class RecordingBoard:
+    """
+    Stands in for a PCA9685. Counts every write and keeps a trace of
+    each channel change with the simulated time it happened at, unless
+    trace is None
+    """
+
+    def __init__(self, name, clock, trace):
+        self.name = name
+        self.clock = clock
+        self.trace = trace
+        self.writes = 0
+        self.channels = {}
+
+    def set_pwm_freq(self, freq_hz):
+        pass
+
+    def set_pwm(self, channel, on, off):
+        self.writes += 1
+        self.record(channel, off)
+
+    def set_all_pwm(self, on, off):
+        # One transaction on the real board, setting all 16 channels
+        self.writes += 1
+        for channel in range(16):
+            self.record(channel, off)
+
+    def record(self, channel, off):
+        if self.channels.get(channel) != off:
+            self.channels[channel] = off
+            if self.trace is not None:
+                self.trace.append((self.clock.now().isoformat(), self.name, channel, off))
+
+class LogAlerts:
+    """Logs alerts instead of texting them, and counts them"""
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.sent = 0
+
+    def alertInfo(self, msg):
+        self.sent += 1
+        self.logger.info(f'[ALERT INFO] {msg}')
+
+    def alertCritical(self, msg):
+        self.sent += 1
+        self.logger.critical(f'[ALERT CRITICAL] {msg}')
+
+class Simulator:
+    """
+    Runs the real Schedule and Electronics on a VirtualClock, ticking
+    the same way HappyFish.start does, as fast as the CPU allows
+
+    Parameters
+    ----------
+    logger : Logger
+        Where the Schedule and Electronics log to
+    start : datetime
+        Local time the simulation starts at
+    tz : tzinfo
+        Time zone of the simulated Pi. The system time zone when None
+    step : float
+        Seconds between ticks, like the sleep in HappyFish.start
+    times : FixedTimes, SolarTimes
+        Where the Schedule gets sunrise and sunset from
+    trace : bool
+        Keeps every channel change. Off for long runs, where it would only grow
+    clock : Clock
+        Runs on this clock instead of a VirtualClock from start and tz
+    """
+
+    def __init__(self, logger, start, tz=None, step=0.5, times=None, trace=True, clock=None):
+        self.logger = logger
+        self.step = step
+
+        # Looks like the single unnamed Tank to HappyFish
+        self.name = None
+
+        self.clock = clock or VirtualClock(start, tz)
+        self.trace = [] if trace else None
+        self.alerts = LogAlerts(logger)
+
+        self.boards = {
+            'led' : RecordingBoard('led', self.clock, self.trace),
+            'rgb' : RecordingBoard('rgb', self.clock, self.trace)
+        }
+
+        self.settings = Settings(logger, False)
+        self.electronics = Electronics(logger, self.settings, clock=self.clock, pwms=self.boards, alerts=self.alerts, times=times)
+
+        self.ticks = 0
+        self.failures = 0
+
+    def run(self, seconds):
+        ticks = int(seconds / self.step)
+
+        wall = perf_counter()
+        cpu = process_time()
+
+        for i in range(ticks):
+            self.tick()
+
+        return perf_counter() - wall, process_time() - cpu
+
+    def tick(self):
+        self.clock.sleep(self.step)
+        if not self.electronics.updateModule():
+            self.failures += 1
+        self.ticks += 1
+
+    def writeTrace(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['time', 'board', 'channel', 'duty_cycle'])
+            writer.writerows(self.trace)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the light schedule on simulated time and record the pwm output')
+    parser.add_argument('--start', default=datetime.now().strftime('%Y-%m-%d'), help='local date (and time) to start at, e.g. 2026-03-01 or 2026-03-01T06:00')
+    parser.add_argument('--days', type=float, default=1, help='how many days to simulate')
+    parser.add_argument('--step', type=float, default=0.5, help='seconds between ticks')
+    parser.add_argument('--tz', help='IANA time zone, e.g. America/New_York. Defaults to the system one')
+    parser.add_argument('--latitude', type=float, help='follow the sun at this latitude instead of 07:00 to 19:00')
+    parser.add_argument('--longitude', type=float, help='longitude to go with --latitude')
+    parser.add_argument('--photoperiod', help='keep the day between these hours, e.g. 8:12')
+    parser.add_argument('--trace', help='write every channel change to this CSV file')
+    parser.add_argument('--verbose', action='store_true', help='print the controller logs')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('simulate')
+    logger.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+
+    tz = None
+    if args.tz:
+        from zoneinfo import ZoneInfo
+        tz = ZoneInfo(args.tz)
+
+    times = None
+    if args.latitude is not None and args.longitude is not None:
+        min_hours = max_hours = None
+        if args.photoperiod:
+            min_hours, max_hours = [float(hours) for hours in args.photoperiod.split(':')]
+        times = SolarTimes(args.latitude, args.longitude, tz, min_hours=min_hours, max_hours=max_hours)
+
+    simulator = Simulator(logger, datetime.fromisoformat(args.start), tz, args.step, times)
+    seconds = timedelta(days=args.days).total_seconds()
+    wall, cpu = simulator.run(seconds)
+
+    if args.trace:
+        simulator.writeTrace(args.trace)
+
+    writes = sum(board.writes for board in simulator.boards.values())
+    days = args.days
+
+    print(f'Simulated {days:g} day(s) from {args.start} in {wall:.2f}s ({cpu:.2f}s CPU)')
+    print(f'Ticks: {simulator.ticks}. Failed ticks: {simulator.failures}')
+    print(f'CPU per simulated day: {cpu / days * 1000:.1f} ms')
+    for name, board in simulator.boards.items():
+        print(f'I2C writes on {name}: {board.writes} ({board.writes / days:.0f} per day)')
+    print(f'I2C writes per tick: {writes / max(simulator.ticks, 1):.2f}')
+    print(f'Channel changes: {len(simulator.trace)}. Stage changes: {simulator.alerts.sent}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from threading import Thread, Event
+from weakref import WeakSet
+from time import perf_counter
+import argparse
+import logging
+import random
+import time
+import gc
+import sys
+from happy_fish import HappyFish
+from simulate import Simulator
+from connection import Connection
+from clock import Clock, VirtualClock
+from config import defaults
+from payload import Payload
+from usage import Usage
+
+# What paho hands to on_message, as far as Connection is concerned
+Message = namedtuple('Message', 'topic payload')
+
+class LoopbackClient:
+    """
+    Stands in for the paho client, with a pretend broker on the other end
+
+    ...
+
+    loop_start() starts a real thread, like paho's network loop, which
+    answers the connect and then idles until loop_stop(). A client that is
+    never stopped therefore shows up in the thread count. Subscribing hands
+    back the retained settings, the way the broker does.
+    """
+
+    def __init__(self, retained):
+        self.retained = retained
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+
+        self.connected = False
+        self.stopping = Event()
+        self.thread = None
+        self.published = 0
+
+    def username_pw_set(self, username, password):
+        pass
+
+    def connect(self, broker):
+        self.broker = broker
+
+    def loop_start(self):
+        self.thread = Thread(target=self.loop, name='loopback', daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        self.connected = True
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+        self.stopping.wait()
+
+    def loop_stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+
+    def disconnect(self):
+        self.connected = False
+
+    def subscribe(self, topic):
+        for message in self.retained():
+            self.deliver(message)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.published += 1
+
+    def deliver(self, message):
+        if self.connected and self.on_message:
+            self.on_message(self, None, message)
+
+    def drop(self):
+        # The broker went away. paho 1.x calls on_disconnect(client, userdata, rc)
+        self.connected = False
+        if self.on_disconnect:
+            self.on_disconnect(self, None, 1)
+
+class LoopbackConnection(Connection):
+    """A real Connection, talking to a LoopbackClient instead of the broker"""
+
+    # Every connection not freed yet, without waiting for the garbage collector
+    alive = WeakSet()
+
+    def __init__(self, *args, retained, **kwargs):
+        self.retained = retained
+        super().__init__(*args, **kwargs)
+        self.alive.add(self)
+
+    def newClient(self):
+        return LoopbackClient(self.retained)
+
+class ScaledClock(Clock):
+    """
+    The wall clock with its real timer thread and real sleeps, only with
+    time running scale times faster. Lets the soak run the threads the
+    Pi runs, for hours, in seconds
+    """
+
+    def __init__(self, logger, start, scale):
+        super().__init__(logger)
+        self.start = start
+        self.scale = scale
+        self.started = time.monotonic()
+
+    def now(self):
+        return self.start + timedelta(seconds=self.monotonic())
+
+    def time(self):
+        return self.start.timestamp() + self.monotonic()
+
+    def monotonic(self):
+        return (time.monotonic() - self.started) * self.scale
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.scale)
+
+    def timer(self, delay, function, args=()):
+        return super().timer(delay / self.scale, function, args)
+
+class Soak(HappyFish):
+    """
+    Runs the real Connection, Settings, Schedule and Electronics for a long
+    time and watches the process for anything that keeps growing
+
+    ...
+
+    The soak is a HappyFish without the hardware, Twilio or the broker.
+    Its main loop ticks the Simulator and calls HappyFish.checkConnection,
+    so a dropped connection goes through the real end(), reconnect timer and
+    HappyFish.reconnect. The clients are LoopbackClients with their own
+    loop thread. MQTT messages are handed to them as if they came from the
+    broker.
+
+    On a VirtualClock, timers run inline and weeks take minutes. The
+    connection thread is waited for after each connect, as only one thread
+    may move virtual time. On a ScaledClock, the timer thread, connection
+    threads and loop threads all run for real, as on the Pi.
+
+    Every sample_hours the garbage is collected and the resident memory,
+    threads, open files and traced memory are sampled. After the first
+    sample none of them may keep growing. Before collecting, the
+    connections still alive are counted. A replaced connection must be
+    freed as soon as HappyFish.reconnect lets go of it, so there may only
+    be the current one and one on its way out.
+
+    Parameters
+    ----------
+    logger : Logger
+        Where the controller logs to
+    clock : VirtualClock, ScaledClock
+        Time the soak runs on
+    step : float
+        Seconds between ticks
+    rate : float
+        MQTT messages per hour
+    disconnect_hours : float
+        Hours between two disconnects
+    sample_hours : float
+        Hours between two samples
+    seed : int
+        Seed of the random traffic, so a failing soak can be run again
+    """
+
+    EMAIL = 'soak@happyfish'
+
+    # HappyFish gives up after 15. The soak keeps reconnecting for weeks
+    MAX_RECONNECTS = float('inf')
+
+    # The current connection, and one that was just replaced
+    MAX_CONNECTIONS = 2
+
+    # Samples taken before the figures are expected to level off
+    WARMUP_SAMPLES = 1
+
+    # Growth allowed between the first and second half of the samples, as a ratio and in bytes
+    MEMORY_RATIO = 1.05
+    RSS_SLACK = 1048576
+    TRACED_SLACK = 262144
+
+    def __init__(self, logger, clock, step=0.5, rate=60, disconnect_hours=6, sample_hours=24, seed=1):
+        self.logger = logger
+        self.clock = clock
+        self.step = step
+        self.rate = rate
+        self.disconnect_interval = disconnect_hours * 3600
+        self.sample_interval = sample_hours * 3600
+        self.random = random.Random(seed)
+
+        self.simulator = Simulator(logger, None, step=step, trace=False, clock=clock)
+        self.settings = self.simulator.settings
+
+        # What HappyFish.reconnect and checkConnection need
+        self.alerts = self.simulator.alerts
+        self.tanks = [self.simulator]
+        self.mqtt_email = self.EMAIL
+        self.mqtt_password = 'soak'
+        self.config = defaults()
+        self.reconnect_count = 0
+        self.reconnect_delay = 60
+        self.reconnecting = False
+
+        self.usage = Usage(True)
+        self.samples = []
+        self.connections = []
+        self.baseline = None
+
+        self.messages = 0
+        self.message_credit = 0.0
+
+        self.connection = self.newConnection()
+        self.connection.start(self)
+        self.settle()
+
+        self.next_disconnect = self.clock.monotonic() + self.disconnect_interval
+        self.next_sample = self.clock.monotonic()
+
+    def run(self, seconds):
+        end = self.clock.monotonic() + seconds
+
+        wall = perf_counter()
+        while self.clock.monotonic() < end:
+            self.simulator.tick()
+            self.checkConnection()
+
+            client = self.connection.client
+            if client.connected:
+                self.message_credit += self.rate * self.step / 3600
+                while self.message_credit >= 1:
+                    self.message_credit -= 1
+                    self.messages += 1
+                    client.deliver(self.randomMessage())
+
+                if self.clock.monotonic() >= self.next_disconnect:
+                    self.next_disconnect = self.clock.monotonic() + self.disconnect_interval
+                    client.drop()
+
+            if self.clock.monotonic() >= self.next_sample:
+                self.next_sample += self.sample_interval
+                self.sample()
+
+        self.sample()
+        return perf_counter() - wall
+
+    def newConnection(self):
+        # HappyFish.newConnection for the single tank, on a loopback client
+        connection = LoopbackConnection(self.logger, self.settings, self.mqtt_email, self.mqtt_password, self.clock, retained=self.retainedMessages)
+        connection.configure(self.config.mqtt)
+        return connection
+
+    def reconnect(self):
+        super().reconnect()
+        self.settle()
+
+    def settle(self):
+        # Only one thread may move a VirtualClock. Wait for the connection to finish with it
+        if isinstance(self.clock, VirtualClock):
+            self.connection.connection_thread.join()
+
+    def retainedMessages(self):
+        root = '/' + self.EMAIL + '/'
+        for shelf, (control, brightness) in list(self.settings.leds.items()):
+            yield Message(root + 'led/control/' + shelf, str(control).encode())
+            yield Message(root + 'led/brightness/' + shelf, str(brightness).encode())
+        for rack, (control, color) in list(self.settings.rgbs.items()):
+            yield Message(root + 'rgb/control/' + rack, str(control).encode())
+            yield Message(root + 'rgb/color/' + rack, Payload.rgba(color).encode())
+
+    def randomMessage(self):
+        root = '/' + self.EMAIL + '/'
+        kind = self.random.random()
+
+        if kind < 0.5:
+            shelf = self.random.choice(list(self.settings.leds.keys()))
+            if kind < 0.2:
+                return Message(root + 'led/control/' + shelf, str(self.random.random() < 0.7).encode())
+            if kind < 0.45:
+                return Message(root + 'led/brightness/' + shelf, str(self.random.randint(0, 100)).encode())
+            return Message(root + 'led/reset/' + shelf, b'')
+
+        rack = self.random.choice(list(self.settings.rgbs.keys()))
+        if kind < 0.6:
+            return Message(root + 'rgb/control/' + rack, str(self.random.random() < 0.5).encode())
+        if kind < 0.95:
+            r, g, b = (self.random.randint(0, 255) for i in range(3))
+            return Message(root + 'rgb/color/' + rack, f'RGBA({r},{g},{b}, 255)'.encode())
+        return Message(root + 'rgb/reset/' + rack, b'')
+
+    def sample(self):
+        self.connections.append(len(LoopbackConnection.alive))
+
+        gc.collect()
+        self.samples.append((self.clock.now(), self.usage.sample()))
+
+        if len(self.samples) == self.WARMUP_SAMPLES + 1:
+            self.baseline = self.usage.snapshot()
+
+    def check(self):
+        """Compares the first and second half of the samples after warming up
+
+        Returns
+        -------
+        list
+            What kept growing. Empty when the soak passed
+        """
+        samples = [sample for time, sample in self.samples[self.WARMUP_SAMPLES:]]
+        if len(samples) < 4:
+            return ['Too few samples. Soak for longer']
+
+        half = len(samples) // 2
+        first, second = samples[:half], samples[half:]
+
+        failures = []
+        if max(self.connections) > self.MAX_CONNECTIONS:
+            failures.append(f'{max(self.connections)} connections were alive at once. Replaced ones are not let go')
+
+        for name in ('rss', 'traced'):
+            slack = self.RSS_SLACK if name == 'rss' else self.TRACED_SLACK
+            limit = max(getattr(sample, name) for sample in first) * self.MEMORY_RATIO + slack
+            peak = max(getattr(sample, name) for sample in second)
+            if peak > limit:
+                failures.append(f'{name} grew to {peak}, over the limit of {limit:.0f}')
+
+        # A connection thread may be caught half way through connecting. One that is never let go is there in every sample
+        for name in ('threads', 'files'):
+            limit = max(getattr(sample, name) for sample in first)
+            least = min(getattr(sample, name) for sample in second)
+            if least > limit:
+                failures.append(f'{name} never went below {least}, over the most of {limit} seen earlier')
+        return failures
+
+    def report(self, title, wall):
+        print(f'{title} in {wall:.1f}s: {self.simulator.ticks} ticks, {self.messages} messages, {self.reconnect_count} reconnects')
+        for (when, sample), connections in zip(self.samples, self.connections):
+            print(f'{when:%Y-%m-%d %H:%M}  {Usage.describe(sample)}, {connections} connections')
+
+        if self.baseline is not None:
+            print('Top growing allocators since the first sample:')
+            for line in self.usage.topAllocators(10, self.baseline):
+                print('  ' + line)
+
+        failures = self.check()
+        for failure in failures:
+            print('FAIL: ' + failure)
+        return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the controller for a long time with MQTT traffic and disconnects, and check that it stays bounded')
+    parser.add_argument('--start', default=datetime.now().strftime('%Y-%m-%d'), help='local date (and time) to start at')
+    parser.add_argument('--days', type=float, default=14, help='how many days to soak on simulated time')
+    parser.add_argument('--step', type=float, default=0.5, help='seconds between ticks. Larger steps soak faster')
+    parser.add_argument('--rate', type=float, default=60, help='MQTT messages per hour')
+    parser.add_argument('--disconnect-hours', type=float, default=6, help='hours between two disconnects on simulated time')
+    parser.add_argument('--real-hours', type=float, default=6, help='hours to soak afterwards on the real timer and connection threads. 0 to skip')
+    parser.add_argument('--scale', type=float, default=1000, help='how much faster than real time those hours run')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the random traffic')
+    parser.add_argument('--verbose', action='store_true', help='print the controller logs')
+    args = parser.parse_args()
+
+    # The controller still logs everything. It is just not printed unless asked
+    logger = logging.getLogger('soak')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(logging.StreamHandler(sys.stderr) if args.verbose else logging.NullHandler())
+
+    start = datetime.fromisoformat(args.start)
+    failures = []
+
+    if args.days > 0:
+        soak = Soak(logger, VirtualClock(start), args.step, args.rate, args.disconnect_hours, 24, args.seed)
+        wall = soak.run(timedelta(days=args.days).total_seconds())
+        failures += soak.report(f'Soaked {args.days:g} simulated day(s)', wall)
+
+    if args.real_hours > 0:
+        # Disconnects every 15 minutes and a sample every 30, so a few hours give enough of both
+        soak = Soak(logger, ScaledClock(logger, start, args.scale), args.step, args.rate, 0.25, 0.5, args.seed)
+        wall = soak.run(args.real_hours * 3600)
+        failures += soak.report(f'Soaked {args.real_hours:g} hour(s) on the real timer thread, {args.scale:g} times faster', wall)
+
+    if failures:
+        sys.exit(1)
+    print('PASS: memory, threads and open files stayed bounded')
+
+if __name__ == '__main__':
+    main()
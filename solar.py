@@ -0,0 +1,156 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+from math import sin, cos, tan, asin, acos, radians, degrees
+
+class SolarTimes:
+    """
+    Sunrise and sunset worked out from where the tank is, following the
+    seasons, for the Schedule
+
+    ...
+
+    Uses the NOAA solar position equations. The sunrise ramp starts at
+    sunrise and the sunset ramp ends at sunset, so the lights are fully
+    off when the sun is down.
+
+    The photoperiod can be kept between min_hours and max_hours. It is then
+    stretched or shrunk around solar noon, which gives a seasonal curve
+    that stays inside what the fish need. In polar day or night it is
+    simply clamped the same way. The day never reaches past midnight: a
+    day of 24 hours or more keeps the lights on all day, and no day at all
+    keeps them off.
+
+    Parameters
+    ----------
+    latitude, longitude : float
+        Degrees. North and east are positive
+    tz : tzinfo
+        Time zone the Pi keeps its clock in. The system one when None
+    duration : int
+        Length of the sunrise and sunset ramps, in minutes
+    min_hours, max_hours : float
+        Optional limits on the time from sunrise to sunset
+
+    Methods
+    -------
+    getTimes(date)
+        Returns [sunrise_start, sunset_start, duration] in seconds of the local day
+    """
+
+    def __init__(self, latitude, longitude, tz=None, duration=30, min_hours=None, max_hours=None):
+        if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            raise ValueError(f'Invalid location {latitude}, {longitude}')
+
+        self.latitude = latitude
+        self.longitude = longitude
+        self.tz = tz
+        self.duration = duration
+        self.min_hours = min_hours
+        self.max_hours = max_hours
+
+    def getTimes(self, date):
+        offset = self.utcOffset(date)
+        sunrise, sunset = sunTimes(date, self.latitude, self.longitude, offset)
+
+        hours = (sunset - sunrise) / 3600
+        noon = (sunrise + sunset) / 2
+        if self.min_hours is not None and hours < self.min_hours:
+            hours = self.min_hours
+        if self.max_hours is not None and hours > self.max_hours:
+            hours = self.max_hours
+
+        # Midnight sun. Lights on the whole day, with no ramp
+        if hours >= 24:
+            return [-1, 86400, 1]
+
+        # The schedule only knows the one local day. Anything past midnight is cut off
+        sunrise = max(noon - hours * 1800, 0)
+        sunset = min(noon + hours * 1800, 86400)
+
+        # Short days get shorter ramps. No day at all stays dark
+        duration_seconds = min(self.duration * 60, int((sunset - sunrise) / 2))
+        if duration_seconds <= 0:
+            return [86400, 86400, 1]
+
+        return [int(sunrise), int(sunset) - duration_seconds, duration_seconds]
+
+    def utcOffset(self, date):
+        # Offset at noon, so the DST change in the early morning is already applied
+        noon = datetime(date.year, date.month, date.day, 12)
+        if self.tz is None:
+            offset = noon.astimezone().utcoffset()
+        else:
+            offset = noon.replace(tzinfo=self.tz).utcoffset()
+        return int(offset / timedelta(minutes=1))
+
+    def describe(self):
+        text = f'Sunrise and sunset follow the sun at {self.latitude}, {self.longitude}'
+        if self.min_hours is not None or self.max_hours is not None:
+            text += f'. Photoperiod kept between {self.min_hours} and {self.max_hours} hours'
+        return text
+
+@lru_cache(maxsize=32)
+def sunTimes(date, latitude, longitude, offset):
+    """Works out sunrise and sunset for one day. Memoised on the date,
+    location and UTC offset, so it runs once a day however many tanks
+    or ticks ask for it
+
+    Parameters
+    ----------
+    date : date
+        Local calendar date
+    latitude, longitude : float
+        Degrees. North and east are positive
+    offset : int
+        UTC offset of the local time on that date, in minutes
+
+    Returns
+    -------
+    tuple
+        Sunrise and sunset in seconds since local midnight. Both are solar
+        noon in polar night, and a full day apart around it in polar day
+    """
+    # Julian century of local noon
+    julian_day = date.toordinal() + 1721424.5 + 0.5 - offset / 1440.0
+    t = (julian_day - 2451545.0) / 36525.0
+
+    mean_longitude = (280.46646 + t * (36000.76983 + t * 0.0003032)) % 360
+    mean_anomaly = 357.52911 + t * (35999.05029 - 0.0001537 * t)
+    eccentricity = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+
+    center = (sin(radians(mean_anomaly)) * (1.914602 - t * (0.004817 + 0.000014 * t))
+              + sin(radians(2 * mean_anomaly)) * (0.019993 - 0.000101 * t)
+              + sin(radians(3 * mean_anomaly)) * 0.000289)
+
+    omega = radians(125.04 - 1934.136 * t)
+    apparent_longitude = mean_longitude + center - 0.00569 - 0.00478 * sin(omega)
+
+    mean_obliquity = 23 + (26 + (21.448 - t * (46.815 + t * (0.00059 - t * 0.001813))) / 60) / 60
+    obliquity = mean_obliquity + 0.00256 * cos(omega)
+
+    declination = asin(sin(radians(obliquity)) * sin(radians(apparent_longitude)))
+
+    y = tan(radians(obliquity / 2)) ** 2
+    l0 = radians(mean_longitude)
+    m = radians(mean_anomaly)
+    equation_of_time = 4 * degrees(y * sin(2 * l0)
+                                   - 2 * eccentricity * sin(m)
+                                   + 4 * eccentricity * y * sin(m) * cos(2 * l0)
+                                   - 0.5 * y * y * sin(4 * l0)
+                                   - 1.25 * eccentricity * eccentricity * sin(2 * m))
+
+    # Minutes since local midnight
+    solar_noon = 720 - 4 * longitude - equation_of_time + offset
+
+    # 90.833 degrees accounts for refraction and the size of the sun's disc
+    cos_hour_angle = (cos(radians(90.833)) / (cos(radians(latitude)) * cos(declination))
+                      - tan(radians(latitude)) * tan(declination))
+
+    if cos_hour_angle >= 1:
+        half_day = 0
+    elif cos_hour_angle <= -1:
+        half_day = 720
+    else:
+        half_day = 4 * degrees(acos(cos_hour_angle))
+
+    return (solar_noon - half_day) * 60, (solar_noon + half_day) * 60
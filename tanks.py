@@ -0,0 +1,127 @@
+from logging import LoggerAdapter
+from settings import Settings
+from electronics import Electronics
+from connection import Connection
+
+class TankLogger(LoggerAdapter):
+    """Prefixes every line with the tank's name, so all tanks can share one log"""
+
+    def process(self, msg, kwargs):
+        return f'[{self.extra["tank"]}] {msg}', kwargs
+
+class Tank:
+    """
+    Everything that belongs to one tank: its settings, its pwm modules
+    and its schedule
+
+    ...
+
+    In multi-tank mode each tank listens under its own topic root,
+    '/MQTT_EMAIL/<name>/', through the Hub. Without tanks, HappyFish runs a
+    single unnamed tank on '/MQTT_EMAIL/' the same way it always has.
+
+    Attributes
+    ----------
+    name : str
+        Name of the tank. None for the single tank
+    logger : Logger
+        The shared logger, prefixed with the tank's name
+    settings : Settings
+        Configuration of the tank's shelves
+    electronics : Electronics
+        The tank's pwm modules and schedule
+    """
+
+    def __init__(self, logger, name, boards=None, split=False, clock=None, alerts=None, renderer=None, times=None):
+        self.name = name
+        self.logger = TankLogger(logger, {'tank': name}) if name else logger
+
+        self.settings = Settings(self.logger, False)
+        self.electronics = Electronics(self.logger, self.settings, split, clock, alerts=alerts, boards=boards, renderer=renderer, times=times, name=name)
+
+    @staticmethod
+    def parse(spec):
+        """Reads HAPPYFISH_TANKS, e.g. 'A:0x40:0x41,B:0x42:0x43'.
+        Each tank is a name, then the I2C address of its LED and RGB modules
+
+        Returns
+        -------
+        dict
+            Tank name mapped to {'led': address, 'rgb': address}
+        """
+        tanks = {}
+        for entry in spec.split(','):
+            name, led, rgb = entry.strip().split(':')
+            if not name or '/' in name or '#' in name or '+' in name:
+                raise ValueError(f'Invalid tank name \'{name}\'')
+            if name in tanks:
+                raise ValueError(f'Tank \'{name}\' is listed twice')
+            tanks[name] = {'led': int(led, 0), 'rgb': int(rgb, 0)}
+
+        addresses = [address for boards in tanks.values() for address in boards.values()]
+        if len(addresses) != len(set(addresses)):
+            raise ValueError('Two pwm modules share an I2C address')
+
+        return tanks
+
+class Hub(Connection):
+    """
+    One MQTT connection shared by every tank
+
+    ...
+
+    The Hub owns the only paho client and a single subscription to
+    '/MQTT_EMAIL/#'. Each tank gets a plain Connection on that client with
+    its own root, stage and settings. Incoming messages are routed to the
+    right tank by the topic level after the root, in one dict lookup.
+    Connecting, timing out and the reconnect bookkeeping are inherited
+    from Connection, so HappyFish treats a Hub like any other connection.
+    """
+
+    def __init__(self, logger, tanks, email, pwd, clock=None):
+        super().__init__(logger, None, email, pwd, clock)
+
+        self.routes = {}
+        for tank in tanks:
+            root = self.root + tank.name + '/'
+            self.routes[tank.name] = Connection(tank.logger, tank.settings, email, pwd, clock, self.client, root)
+
+        self.logger.info(f'Hub is routing tanks {list(self.routes.keys())} under \'{self.root}\'')
+
+    def established(self):
+        self.logger.info('Connection is established with the MQTT broker')
+
+        for connection in self.routes.values():
+            connection.beginRetained()
+
+        self.logger.info('Subscribing to root topic \''+self.root+'#\' for every tank')
+        self.client.subscribe(self.root+'#')
+
+        self.clock.sleep(2)
+
+        for connection in self.routes.values():
+            connection.endRetained()
+
+    def release(self):
+        for connection in self.routes.values():
+            connection.release()
+        super().release()
+
+    def configure(self, mqtt):
+        super().configure(mqtt)
+        for connection in self.routes.values():
+            connection.configure(mqtt)
+
+    def on_message(self, client, userdata, message):
+        topic = message.topic
+        end = topic.find('/', self.root_len)
+
+        connection = None
+        if end != -1 and topic.startswith(self.root):
+            connection = self.routes.get(topic[self.root_len:end])
+
+        if connection is None:
+            self.logger.debug(f'No tank for TOPIC [{topic}]')
+            return
+
+        connection.on_message(client, userdata, message)
@@ -0,0 +1,87 @@
+from collections import namedtuple
+from threading import active_count
+import tracemalloc
+import os
+import metrics
+
+Sample = namedtuple('Sample', 'rss threads files traced')
+
+class Usage:
+    """
+    Memory, thread and file figures of this process, to spot anything
+    that keeps growing over weeks of running
+
+    ...
+
+    The resident memory comes from /proc/self/statm and the open files
+    from /proc/self/fd, so both read as 0 away from Linux. Python's own
+    allocations are only known while tracemalloc runs, which slows every
+    allocation down, so it is opt-in.
+
+    Methods
+    -------
+    sample()
+        Takes the current figures and sets the matching metrics
+    topAllocators(limit)
+        Lines that allocated the most since tracing started
+    describe(sample)
+        One line summary of a sample for the log
+    """
+
+    # Frames kept per traced allocation
+    TRACE_DEPTH = 1
+
+    def __init__(self, tracing=False):
+        self.tracing = tracing
+        if tracing and not tracemalloc.is_tracing():
+            tracemalloc.start(self.TRACE_DEPTH)
+
+        self.page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+    def sample(self):
+        try:
+            with open('/proc/self/statm') as f:
+                rss = int(f.read().split()[1]) * self.page_size
+        except (OSError, ValueError, IndexError):
+            rss = 0
+
+        try:
+            files = len(os.listdir('/proc/self/fd'))
+        except OSError:
+            files = 0
+
+        traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+
+        sample = Sample(rss, active_count(), files, traced)
+
+        metrics.resident_bytes.set(sample.rss)
+        metrics.threads.set(sample.threads)
+        metrics.open_files.set(sample.files)
+        metrics.traced_bytes.set(sample.traced)
+        return sample
+
+    def snapshot(self):
+        if not tracemalloc.is_tracing():
+            return None
+        return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+    def topAllocators(self, limit=5, since=None):
+        """Returns the lines holding the most memory, as text. With a
+        snapshot to compare against, the lines that grew the most since then
+        """
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return []
+
+        if since is None:
+            stats = snapshot.statistics('lineno')
+        else:
+            stats = snapshot.compare_to(since, 'lineno')
+        return [str(stat) for stat in stats[:limit]]
+
+    @staticmethod
+    def describe(sample):
+        text = f'RSS {sample.rss / 1048576:.1f} MiB, {sample.threads} threads, {sample.files} open files'
+        if sample.traced:
+            text += f', {sample.traced / 1048576:.2f} MiB traced'
+        return text
@@ -0,0 +1,190 @@
+from collections import Counter
+from threading import Thread, Lock, get_ident, enumerate as all_threads
+from time import monotonic, sleep
+import os
+import sys
+import metrics
+
+class Watchdog:
+    """
+    Watches the main loop for ticks that run past their deadline
+
+    ...
+
+    A daemon thread checks the running tick against a monotonic deadline.
+    Once a tick overruns, the stacks of every thread are sampled while the
+    tick is still stuck, and the hottest stacks are written to the log.
+    The same sampler can run as a periodic profiler, switched on and off
+    at runtime with toggleProfiler() (HappyFish wires it to SIGUSR1).
+
+    Methods
+    -------
+    begin(name)
+        Marks the start of a tick
+    end()
+        Marks the end of a tick
+    toggleProfiler()
+        Starts or stops the sampling profiler
+    """
+
+    # Longest a tick may take before it counts as an overrun, in seconds
+    DEADLINE = 0.25
+
+    # How often the deadline is checked, in seconds
+    CHECK_INTERVAL = 0.05
+
+    # Stack samples taken while a tick is overrunning
+    OVERRUN_SAMPLES = 10
+    OVERRUN_SAMPLE_INTERVAL = 0.01
+
+    # Sampling profiler interval and how often it reports, in seconds
+    PROFILE_INTERVAL = 0.02
+    PROFILE_REPORT = 60
+
+    # How much of each stack, and how many stacks, go into a summary
+    STACK_DEPTH = 6
+    TOP_STACKS = 5
+
+    def __init__(self, logger):
+        self.logger = logger
+
+        self.lock = Lock()
+        self.tick_name = None
+        self.tick_started = None
+        self.tick_reported = False
+
+        self.overruns = 0
+
+        self.profiling = False
+        self.profile = Counter()
+        self.profile_samples = 0
+
+        self.running = True
+        self.monitor_thread = Thread(target=self.monitor, args=(), name='watchdog', daemon=True)
+        self.monitor_thread.start()
+
+        self.logger.info(f'Watchdog started with a {self.DEADLINE}s tick deadline')
+
+    def begin(self, name):
+        with self.lock:
+            self.tick_name = name
+            self.tick_started = monotonic()
+            self.tick_reported = False
+
+    def end(self):
+        with self.lock:
+            elapsed = monotonic() - self.tick_started
+            reported = self.tick_reported
+            name = self.tick_name
+            self.tick_started = None
+
+        if elapsed > self.DEADLINE:
+            self.overruns += 1
+            metrics.tick_overruns.inc()
+            if not reported:
+                self.logger.warning(f'Tick \'{name}\' overran its deadline but finished before it could be sampled')
+            self.logger.warning(f'Tick \'{name}\' took {elapsed*1000:.1f} ms. Overrun count is {self.overruns}')
+
+        return elapsed
+
+    def stop(self):
+        self.running = False
+
+    def monitor(self):
+        while self.running:
+            sleep(self.CHECK_INTERVAL)
+
+            with self.lock:
+                started = self.tick_started
+                overrun = started is not None and not self.tick_reported and monotonic() - started > self.DEADLINE
+                if overrun:
+                    self.tick_reported = True
+                    name = self.tick_name
+
+            if overrun:
+                self.reportOverrun(name, started)
+
+    def reportOverrun(self, name, started):
+        stacks = Counter()
+        for i in range(self.OVERRUN_SAMPLES):
+            self.sample(stacks)
+            sleep(self.OVERRUN_SAMPLE_INTERVAL)
+
+            # Tick finished while sampling. What we have is enough
+            if self.tick_started != started:
+                break
+
+        elapsed = monotonic() - started
+        self.logger.critical(f'Tick \'{name}\' is overrunning. {elapsed*1000:.1f} ms so far. Hot stacks:')
+        self.logSummary(stacks, self.logger.critical)
+
+    def sample(self, stacks):
+        names = {thread.ident: thread.name for thread in all_threads()}
+
+        # The watchdog's own threads are only ever sleeping or sampling
+        skip = {get_ident(), self.monitor_thread.ident}
+        if self.profiling:
+            skip.add(self.profiler_thread.ident)
+
+        for ident, frame in sys._current_frames().items():
+            if ident in skip:
+                continue
+
+            stack = []
+            while frame is not None and len(stack) < self.STACK_DEPTH:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}')
+                frame = frame.f_back
+
+            stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+
+    def logSummary(self, stacks, log):
+        total = sum(stacks.values())
+        for (thread, stack), count in stacks.most_common(self.TOP_STACKS):
+            log(f'  {count}/{total} [{thread}] ' + ' <- '.join(stack))
+
+    def toggleProfiler(self):
+        if self.profiling:
+            self.stopProfiler()
+        else:
+            self.startProfiler()
+
+    def startProfiler(self):
+        if self.profiling:
+            return
+
+        self.logger.info(f'Sampling profiler started. Sampling every {self.PROFILE_INTERVAL}s')
+        self.profile = Counter()
+        self.profile_samples = 0
+
+        # sample() reads profiler_thread as soon as profiling is set, and the profiler stops once it is cleared
+        self.profiler_thread = Thread(target=self.profiler, args=(), name='profiler', daemon=True)
+        self.profiling = True
+        self.profiler_thread.start()
+
+    def stopProfiler(self):
+        if not self.profiling:
+            return
+
+        self.profiling = False
+        self.profiler_thread.join()
+        self.reportProfile()
+        self.logger.info('Sampling profiler stopped')
+
+    def profiler(self):
+        last_report = monotonic()
+
+        while self.profiling and self.running:
+            self.sample(self.profile)
+            self.profile_samples += 1
+            sleep(self.PROFILE_INTERVAL)
+
+            if monotonic() - last_report > self.PROFILE_REPORT:
+                self.reportProfile()
+                last_report = monotonic()
+
+    def reportProfile(self):
+        self.logger.info(f'Profiler report over {self.profile_samples} samples. Hot stacks:')
+        self.logSummary(self.profile, self.logger.info)
+        self.profile = Counter()
+        self.profile_samples = 0